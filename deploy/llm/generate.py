@@ -11,10 +11,15 @@
 """A wrapper over the TensorRT-LLM high level API runner."""
 
 import json
-from io import BytesIO
+import os
+import struct
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from multiprocessing import resource_tracker
 from multiprocessing.shared_memory import SharedMemory
 from pathlib import Path
-from typing import Any, Dict, Iterable, List, Optional, Union
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
 import torch
 from tensorrt_llm.executor import Fifo
@@ -22,6 +27,221 @@ from tensorrt_llm.hlapi import KvCacheConfig as TRT_KvCacheConfig
 from tensorrt_llm.hlapi import SamplingParams
 from tensorrt_llm.hlapi.llm import LLM as TRT_LLM
 from tensorrt_llm.hlapi.tokenizer import TokenizerBase, TransformersTokenizer
+from torch.multiprocessing.reductions import rebuild_cuda_tensor, reduce_tensor
+
+_SHM_PREFIX = "_generate_trtllm_request_id_"
+
+
+def _is_tagged(obj: Any, tag: str) -> bool:
+    """Returns whether obj is a tuple standing in for a tensor of the given IPC kind."""
+    return isinstance(obj, tuple) and len(obj) > 0 and isinstance(obj[0], str) and obj[0] == tag
+
+
+# CUDA tensors are sent as (_CUDA_IPC_TAG, rebuild_fn_name, rebuild_args) so the receiver can map
+# the device memory directly instead of round-tripping it through host shared memory.
+_CUDA_IPC_TAG = "__ipc__"
+_IPC_REBUILD_FNS = {fn.__name__: fn for fn in [rebuild_cuda_tensor]}
+
+# CPU tensors in shared memory are laid out as a fixed size header holding the dtype code and shape
+# followed by the raw tensor bytes at _SHM_DATA_OFFSET, so only the segment name has to be sent.
+# The first bytes before the header are reserved for the busy flag of pool slots.
+_SHM_HEADER_OFFSET = 8
+_SHM_HEADER = struct.Struct("<BB6x8q")
+_SHM_MAX_NDIM = 8
+_SHM_DATA_OFFSET = 128
+_SHM_DTYPES = [
+    torch.float32,
+    torch.float16,
+    torch.bfloat16,
+    torch.float64,
+    torch.int64,
+    torch.int32,
+    torch.int16,
+    torch.int8,
+    torch.uint8,
+    torch.bool,
+]
+_SHM_DTYPE_CODES = {dtype: code for code, dtype in enumerate(_SHM_DTYPES)}
+
+# CUDA tensors that cannot be shared via CUDA IPC are staged to host memory and sent as
+# (_CUDA_STAGED_TAG, device_index, payload) so the receiver moves them back to their device.
+_CUDA_STAGED_TAG = "__cuda_staged__"
+
+# CPU tensors that do not fit into the shared memory pool get their own segment which is unlinked
+# by the receiver.
+_SHM_SEGMENT_TAG = "__shm__"
+
+
+# CPU tensors that fit are copied into a small pool of shared memory slots that are created on
+# demand per producer and recycled instead of creating and unlinking a segment per tensor.
+# The first byte of a slot is set while the slot holds data the receiver has not consumed yet.
+# Slots are sized to the tensors they hold and grown (re-created under a new name) when a larger
+# tensor arrives, up to the max slot size. The max slot size is derived from the engine config by
+# ``LLM`` (largest context logits tensor) and passed to the executor processes through the
+# environment. Written slot pages stay resident in /dev/shm for the lifetime of the fifo, so slots
+# are only created or grown while /dev/shm has room for them; otherwise the tensor gets its own
+# segment.
+_SHM_POOL_TAG = "__shm_pool__"
+_SHM_POOL_NUM_SLOTS = 8
+_SHM_POOL_MIN_SLOT_BYTES = 1 << 20
+_SHM_POOL_MAX_SLOT_BYTES_ENV = "MODELOPT_GENERATE_SHM_POOL_MAX_SLOT_BYTES"
+_SHM_POOL_DEFAULT_MAX_SLOT_BYTES = 64 << 20
+_SHM_DIR = "/dev/shm"
+
+
+def _shm_pool_max_slot_bytes() -> int:
+    return int(os.environ.get(_SHM_POOL_MAX_SLOT_BYTES_ENV, _SHM_POOL_DEFAULT_MAX_SLOT_BYTES))
+
+
+def _shm_has_room(size: int) -> bool:
+    """Returns whether /dev/shm can take another size bytes, keeping the same amount in reserve."""
+    try:
+        stats = os.statvfs(_SHM_DIR)
+    except OSError:
+        return True
+    return stats.f_bavail * stats.f_frsize >= 2 * size
+
+
+def _release_shm_pool(pool: List[Optional[SharedMemory]]):
+    for shm in pool:
+        if shm is not None:
+            shm.close()
+            shm.unlink()
+
+
+def _create_shm_slot(fifo: Fifo, index: int, size: int) -> SharedMemory:
+    fifo._shm_pool_generation = getattr(fifo, "_shm_pool_generation", 0) + 1
+    return SharedMemory(
+        name=f"{_SHM_PREFIX}pool_{os.getpid()}_{id(fifo)}_{index}_{fifo._shm_pool_generation}",
+        create=True,
+        size=size,
+    )
+
+
+def _acquire_shm_slot(fifo: Fifo, nbytes: int) -> Optional[Tuple[int, SharedMemory]]:
+    """Returns a free (index, slot) of the fifo's shared memory pool that can hold nbytes.
+
+    Returns None if all slots are busy, if nbytes exceeds the max slot size or if /dev/shm has no
+    room for a new or grown slot.
+    """
+    size = _SHM_DATA_OFFSET + nbytes
+    max_slot_bytes = _shm_pool_max_slot_bytes()
+    if size > max_slot_bytes:
+        return None
+    pool = getattr(fifo, "_shm_pool", None)
+    if pool is None:
+        pool = fifo._shm_pool = [None] * _SHM_POOL_NUM_SLOTS
+        weakref.finalize(fifo, _release_shm_pool, pool)
+
+    # Prefer the smallest free slot which is large enough
+    free = [i for i, shm in enumerate(pool) if shm is None or shm.buf[0] == 0]
+    fitting = [i for i in free if pool[i] is not None and pool[i].size >= size]
+    if fitting:
+        index = min(fitting, key=lambda i: pool[i].size)
+    elif free:
+        # Create an empty slot if there is one left, else grow the largest free slot
+        index = min(free, key=lambda i: (0, 0) if pool[i] is None else (1, -pool[i].size))
+        slot_size = min(max(_SHM_POOL_MIN_SLOT_BYTES, 1 << (size - 1).bit_length()), max_slot_bytes)
+        old = pool[index]
+        if not _shm_has_room(slot_size - (0 if old is None else old.size)):
+            return None
+        if old is not None:
+            # The receiver has consumed the slot; its mapping is replaced once it sees the new name.
+            old.close()
+            old.unlink()
+        pool[index] = _create_shm_slot(fifo, index, slot_size)
+    else:
+        return None
+
+    shm = pool[index]
+    shm.buf[0] = 1
+    return index, shm
+
+
+def _close_shm_mappings(attached: Dict[int, SharedMemory]):
+    for shm in attached.values():
+        shm.close()
+
+
+def _attach_shm_slot(fifo: Fifo, index: int, name: str) -> SharedMemory:
+    """Returns the receiver's mapping of a pool slot, replacing a stale mapping of a grown slot."""
+    attached = getattr(fifo, "_shm_attached", None)
+    if attached is None:
+        attached = fifo._shm_attached = {}
+        weakref.finalize(fifo, _close_shm_mappings, attached)
+    shm = attached.get(index)
+    if shm is None or shm.name != name:
+        if shm is not None:
+            shm.close()
+        shm = attached[index] = SharedMemory(name=name, create=False)
+        # The producer owns the pool and unlinks it; don't let this process's tracker unlink it too.
+        resource_tracker.unregister(shm._name, "shared_memory")  # type: ignore[attr-defined]
+    return shm
+
+
+def _is_shm_compatible(t: torch.Tensor) -> bool:
+    return t.dtype in _SHM_DTYPE_CODES and t.ndim <= _SHM_MAX_NDIM
+
+
+def _write_tensor(buf: memoryview, t: torch.Tensor):
+    shape = [*t.shape] + [0] * (_SHM_MAX_NDIM - t.ndim)
+    _SHM_HEADER.pack_into(buf, _SHM_HEADER_OFFSET, _SHM_DTYPE_CODES[t.dtype], t.ndim, *shape)
+    if t.numel():
+        dst = torch.frombuffer(buf, dtype=torch.uint8, count=t.nbytes, offset=_SHM_DATA_OFFSET)
+        dst.copy_(t.contiguous().view(-1).view(torch.uint8))
+
+
+def _read_tensor(buf: memoryview) -> torch.Tensor:
+    dtype_code, ndim, *shape = _SHM_HEADER.unpack_from(buf, _SHM_HEADER_OFFSET)
+    out = torch.empty(shape[:ndim], dtype=_SHM_DTYPES[dtype_code])
+    if out.numel():
+        src = torch.frombuffer(buf, dtype=torch.uint8, count=out.nbytes, offset=_SHM_DATA_OFFSET)
+        out.view(-1).view(torch.uint8).copy_(src)
+    return out
+
+
+def _save_tensor(name: str, t: torch.Tensor):
+    shm_writer = SharedMemory(name=name, create=True, size=_SHM_DATA_OFFSET + t.nbytes)
+    _write_tensor(shm_writer.buf, t)
+    shm_writer.close()
+
+
+# Max number of threads used to copy the tensors of a single message into shared memory.
+_IO_POOL_MAX_WORKERS = 4
+
+
+def _run_writes(fifo: Fifo, writes: List[Callable[[], None]]):
+    """Runs the tensor writes of a message, overlapping them on the fifo's thread pool if needed."""
+    if len(writes) <= 1:
+        for write in writes:
+            write()
+        return
+    io_pool = getattr(fifo, "_io_pool", None)
+    if io_pool is None:
+        io_pool = fifo._io_pool = ThreadPoolExecutor(max_workers=_IO_POOL_MAX_WORKERS)
+    for future in [io_pool.submit(write) for write in writes]:
+        future.result()
+
+
+def _stage_to_host(fifo: Fifo, t: torch.Tensor) -> torch.Tensor:
+    """Schedules an async copy of a CUDA tensor to pinned host memory on a side stream.
+
+    The pinned buffer comes from PyTorch's caching host allocator so it is recycled across calls.
+    The side stream of the tensor's device must be synchronized before the copy is read.
+    """
+    streams = getattr(fifo, "_d2h_streams", None)
+    if streams is None:
+        streams = fifo._d2h_streams = {}
+    if t.device not in streams:
+        streams[t.device] = torch.cuda.Stream(device=t.device)
+    stream = streams[t.device]
+    stream.wait_stream(torch.cuda.current_stream(t.device))
+    with torch.cuda.stream(stream):
+        host_t = torch.empty(t.shape, dtype=t.dtype, pin_memory=True)
+        host_t.copy_(t, non_blocking=True)
+    # t may be freed by the caller before the copy is done.
+    t.record_stream(stream)
+    return host_t
 
 
 def _put(self, obj: Any):
@@ -31,14 +251,40 @@ def _put(self, obj: Any):
         obj_list = list(obj)
         if isinstance(obj_list[1], tuple):
             tensors = list(obj_list[1])
+            writes = []
+            staged = False
             for i, t in enumerate(tensors):
-                if torch.is_tensor(t):
-                    # TODO: think about ways to accelerate the context logits IPC.
-                    name = f"_generate_trtllm_request_id_{obj_list[0]}_tensor_{i}"
-                    shm_writer = SharedMemory(name=name, create=True, size=t.nbytes + 2048)
-                    torch.save(t, shm_writer._mmap)  # type: ignore[attr-defined]
-                    shm_writer.close()
-                    tensors[i] = name
+                if not torch.is_tensor(t):
+                    continue
+                staged_device = None
+                if t.is_cuda:
+                    try:
+                        # Only a small CUDA IPC handle is sent; the storage itself is not copied.
+                        rebuild_fn, rebuild_args = reduce_tensor(t)
+                        tensors[i] = (_CUDA_IPC_TAG, rebuild_fn.__name__, rebuild_args)
+                        continue
+                    except RuntimeError:
+                        # Memory not owned by the caching allocator cannot be shared via CUDA IPC.
+                        staged_device = t.device.index
+                        t = _stage_to_host(self, t)
+                        staged = True
+                if not _is_shm_compatible(t):
+                    # Rare dtypes and ranks fall back to torch.multiprocessing's tensor pickling.
+                    tensors[i] = t
+                elif (slot := _acquire_shm_slot(self, t.nbytes)) is not None:
+                    index, shm = slot
+                    writes.append(partial(_write_tensor, shm.buf, t))
+                    tensors[i] = (_SHM_POOL_TAG, index, shm.name)
+                else:
+                    name = f"{_SHM_PREFIX}{obj_list[0]}_tensor_{i}"
+                    writes.append(partial(_save_tensor, name, t))
+                    tensors[i] = (_SHM_SEGMENT_TAG, name)
+                if staged_device is not None:
+                    tensors[i] = (_CUDA_STAGED_TAG, staged_device, tensors[i])
+            if staged:
+                for stream in self._d2h_streams.values():
+                    stream.synchronize()
+            _run_writes(self, writes)
             obj_list[1] = tuple(tensors)
         obj = tuple(obj_list)
 
@@ -56,11 +302,24 @@ def _get(self) -> Any:
         if isinstance(obj_list[1], tuple):
             tensors = list(obj_list[1])
             for i, t in enumerate(tensors):
-                if isinstance(t, str) and t.startswith("_generate_trtllm_request_id_"):
-                    shm_reader = SharedMemory(name=t, create=False)
-                    tensors[i] = torch.load(BytesIO(shm_reader.buf))
+                staged_device = None
+                if _is_tagged(t, _CUDA_STAGED_TAG):
+                    _, staged_device, t = t
+                    tensors[i] = t
+                if _is_tagged(t, _CUDA_IPC_TAG):
+                    tensors[i] = _IPC_REBUILD_FNS[t[1]](*t[2])
+                elif _is_tagged(t, _SHM_POOL_TAG):
+                    shm = _attach_shm_slot(self, t[1], t[2])
+                    tensors[i] = _read_tensor(shm.buf)
+                    shm.buf[0] = 0
+                elif _is_tagged(t, _SHM_SEGMENT_TAG):
+                    shm_reader = SharedMemory(name=t[1], create=False)
+                    tensors[i] = _read_tensor(shm_reader.buf)
                     shm_reader.close()
                     shm_reader.unlink()
+                if staged_device is not None:
+                    # Restore the tensor on the CUDA device it was sent from
+                    tensors[i] = tensors[i].to(f"cuda:{staged_device}")
             obj_list[1] = tuple(tensors)
         obj = tuple(obj_list)
     return obj
@@ -85,6 +344,13 @@ def _sanitize_temperature_and_top_p(temperature, top_p):
     return kwargs
 
 
+@lru_cache(maxsize=8)
+def _load_engine_config(engine_config_path: Path, mtime_ns: int) -> Dict[str, Any]:
+    # mtime_ns is part of the cache key so that a rebuilt engine is not served a stale config.
+    with open(engine_config_path, "r") as engine_config_file:
+        return json.load(engine_config_file)
+
+
 class LLM(TRT_LLM):
     """A wrapper over the ``tensorrt_llm.hlapi.llm.LLM`` for LLM profiling and validation."""
 
@@ -102,16 +368,27 @@ class LLM(TRT_LLM):
             kv_cache_config: the kv cache config as a dict. Please refer to
                 https://github.com/NVIDIA/TensorRT-LLM/blob/main/docs/source/performance/perf-best-practices.md
         """
-        with open(Path(engine_dir) / "config.json", "r") as engine_config_file:
-            engine_config = json.load(engine_config_file)
-            build_config = engine_config["build_config"]
-            world_size = (
-                engine_config.get("pretrained_config", {}).get("mapping", {}).get("world_size", 1)
-            )
-            max_tokens_in_paged_kv_cache = (
-                build_config["max_seq_len"] * build_config["max_batch_size"] // world_size
-            )
-            self.gather_context_logits = build_config.get("gather_context_logits", False)
+        engine_config_path = Path(engine_dir) / "config.json"
+        engine_config = _load_engine_config(
+            engine_config_path, engine_config_path.stat().st_mtime_ns
+        )
+        build_config = engine_config["build_config"]
+        world_size = (
+            engine_config.get("pretrained_config", {}).get("mapping", {}).get("world_size", 1)
+        )
+        max_tokens_in_paged_kv_cache = (
+            build_config["max_seq_len"] * build_config["max_batch_size"] // world_size
+        )
+        self.gather_context_logits = build_config.get("gather_context_logits", False)
+
+        # Size the executor's shared memory slots so that the largest logits tensor fits into one
+        vocab_size = engine_config.get("pretrained_config", {}).get("vocab_size", 0)
+        max_logits_bytes = (
+            build_config["max_seq_len"] * build_config.get("max_beam_width", 1) * vocab_size * 4
+        )
+        os.environ[_SHM_POOL_MAX_SLOT_BYTES_ENV] = str(
+            max(_shm_pool_max_slot_bytes(), _SHM_DATA_OFFSET + max_logits_bytes)
+        )
 
         trt_kv_cache_config = TRT_KvCacheConfig()
 
@@ -150,6 +427,41 @@ class LLM(TRT_LLM):
         """Get the max beam width from the LLM instance."""
         return self.args.build_config.max_beam_width
 
+    def _encode_prompts(
+        self, prompts: Union[Iterable[str], Iterable[List[int]]]
+    ) -> List[List[int]]:
+        """Encodes the string prompts, batching them through the HF fast tokenizer if available."""
+        prompts = list(prompts)
+        hf_tokenizer = getattr(self.tokenizer, "tokenizer", None)
+        if not getattr(hf_tokenizer, "is_fast", False):
+            return [
+                self.tokenizer.encode(prompt) if isinstance(prompt, str) else prompt
+                for prompt in prompts
+            ]
+
+        str_indices = [i for i, prompt in enumerate(prompts) if isinstance(prompt, str)]
+        if str_indices:
+            str_prompts = [prompts[i] for i in str_indices]
+            input_ids = hf_tokenizer(str_prompts, return_attention_mask=False)["input_ids"]
+            for i, ids in zip(str_indices, input_ids):
+                prompts[i] = ids
+        return prompts
+
+    def _generate_in_order(
+        self, prompt_ids: List[List[int]], sampling_config: SamplingParams
+    ) -> Iterator[Any]:
+        """Submits all the prompts to the executor up front and yields their outputs in order.
+
+        Later prompts join the in-flight batch as earlier ones finish while the caller is already
+        processing the outputs which are done.
+        """
+        futures = [
+            self.generate_async(prompt_id, sampling_params=sampling_config)
+            for prompt_id in prompt_ids
+        ]
+        for future in futures:
+            yield future.result()
+
     def generate_tokens(
         self,
         prompts: Union[Iterable[str], Iterable[List[int]]],
@@ -180,41 +492,21 @@ class LLM(TRT_LLM):
             max_new_tokens=max_new_tokens, beam_width=beam_width, stop=stop_words, **kwargs
         )
 
-        prompt_ids = [
-            self.tokenizer.encode(prompt) if isinstance(prompt, str) else prompt
-            for prompt in prompts
-        ]
-        outputs = self.generate(prompt_ids, sampling_params=sampling_config)
-
-        def _process_output_token_id(output_token_id, prompt_id, with_input, keep_input_prompt):
-            if with_input == keep_input_prompt:
-                return output_token_id
-
-            elif with_input:  # and not keep_input_prompt
-                return output_token_id[len(prompt_id) :]
-
-            else:  # not with_input and keep_input_prompt:
-                return prompt_id + output_token_id
-
-        with_input = False
-        output_tokens = []
-        for prompt_id, output in zip(prompt_ids, outputs):
-            output_token_ids = [out.token_ids for out in output.outputs]
-
-            for output_token_id in output_token_ids:
-                output_tokens.append(
-                    _process_output_token_id(
-                        output_token_id, prompt_id, with_input, keep_input_prompt
-                    )
-                )
-
-        return (
-            output_tokens
-            if beam_width == 1
-            else [
-                output_tokens[i : i + beam_width] for i in range(0, len(output_tokens), beam_width)
+        prompt_ids = self._encode_prompts(prompts)
+        outputs = self._generate_in_order(prompt_ids, sampling_config)
+
+        # The output token ids do not include the input prompt.
+        output_tokens = [
+            [
+                prompt_id + out.token_ids if keep_input_prompt else out.token_ids
+                for out in output.outputs
             ]
-        )
+            for prompt_id, output in zip(prompt_ids, outputs)
+        ]
+
+        if beam_width == 1:
+            return [beam for beams in output_tokens for beam in beams]
+        return output_tokens
 
     def generate_text(
         self,
@@ -281,10 +573,7 @@ class LLM(TRT_LLM):
 
         sampling_config = SamplingParams(max_new_tokens=1, beam_width=1, **kwargs)
 
-        prompt_ids = [
-            self.tokenizer.encode(prompt) if isinstance(prompt, str) else prompt
-            for prompt in prompts
-        ]
-        outputs = self.generate(prompt_ids, sampling_params=sampling_config)
+        prompt_ids = self._encode_prompts(prompts)
+        outputs = self._generate_in_order(prompt_ids, sampling_config)
 
         return [output.context_logits for output in outputs]
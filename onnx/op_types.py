@@ -11,9 +11,8 @@
 """Utility functions to categorize onnx ops."""
 
 
-def is_unary_op(op_type: str):
-    """Returns whether the given op is a unary operator or not."""
-    return op_type in [
+_UNARY_OPS = frozenset(
+    [
         "Neg",
         "Sqrt",
         "Abs",
@@ -44,11 +43,16 @@ def is_unary_op(op_type: str):
         "InstanceNormalization",
         "CumSum",
     ]
+)
 
 
-def is_binary_op(op_type: str):
-    """Returns whether the given op is a binary operator or not."""
-    return op_type in [
+def is_unary_op(op_type: str):
+    """Returns whether the given op is a unary operator or not."""
+    return op_type in _UNARY_OPS
+
+
+_BINARY_OPS = frozenset(
+    [
         "Add",
         "Sub",
         "Mul",
@@ -66,11 +70,16 @@ def is_binary_op(op_type: str):
         "BitwiseXor",
         "BitShift",
     ]
+)
 
 
-def is_fusible_reduction_op(op_type: str):
-    """Returns whether the given op type is of reduction category and fusible by the compiler."""
-    return op_type in [
+def is_binary_op(op_type: str):
+    """Returns whether the given op is a binary operator or not."""
+    return op_type in _BINARY_OPS
+
+
+_FUSIBLE_REDUCTION_OPS = frozenset(
+    [
         "ReduceMax",
         "ReduceMin",
         "ReduceMean",
@@ -78,11 +87,16 @@ def is_fusible_reduction_op(op_type: str):
         "ReduceSum",
         "TopK",  # Transformed to BottomK based on `largest` param
     ]
+)
 
 
-def is_copy_op(op_type: str):
-    """Returns whether the given op is a copy operator or not."""
-    return op_type in [
+def is_fusible_reduction_op(op_type: str):
+    """Returns whether the given op type is of reduction category and fusible by the compiler."""
+    return op_type in _FUSIBLE_REDUCTION_OPS
+
+
+_COPY_OPS = frozenset(
+    [
         "Flatten",
         "Transpose",
         "Concat",
@@ -100,11 +114,23 @@ def is_copy_op(op_type: str):
         "ScatterND",
         "OneHot",
     ]
+)
+
+
+def is_copy_op(op_type: str):
+    """Returns whether the given op is a copy operator or not."""
+    return op_type in _COPY_OPS
+
+
+_LINEAR_OPS = frozenset(["Conv", "Gemm", "MatMul"])
 
 
 def is_linear_op(op_type: str):
     """Returns whether the given op type is of Linear category or not."""
-    return op_type in ["Conv", "Gemm", "MatMul"]
+    return op_type in _LINEAR_OPS
+
+
+_POINTWISE_OR_ELEMENTWISE_OPS = _UNARY_OPS | _BINARY_OPS
 
 
 def is_pointwise_or_elementwise_op(op_type: str):
@@ -112,12 +138,11 @@ def is_pointwise_or_elementwise_op(op_type: str):
 
     This considers only the fusible types.
     """
-    return is_unary_op(op_type) or is_binary_op(op_type)
+    return op_type in _POINTWISE_OR_ELEMENTWISE_OPS
 
 
-def is_pooling_or_window_op(op_type: str):
-    """Returns whether the given op type is of Pooling/Window category or not."""
-    return op_type in [
+_POOLING_OR_WINDOW_OPS = frozenset(
+    [
         "AveragePool",
         "GlobalAveragePool",
         "MaxPool",
@@ -129,11 +154,16 @@ def is_pooling_or_window_op(op_type: str):
         "BlackmanWindow",
         "HannWindow",
     ]
+)
 
 
-def is_normalization_op(op_type: str):
-    """Returns whether the given op type is of Normalization category or not."""
-    return op_type in [
+def is_pooling_or_window_op(op_type: str):
+    """Returns whether the given op type is of Pooling/Window category or not."""
+    return op_type in _POOLING_OR_WINDOW_OPS
+
+
+_NORMALIZATION_OPS = frozenset(
+    [
         "BatchNormalization",
         "InstanceNormalization",
         "LRN",
@@ -141,21 +171,32 @@ def is_normalization_op(op_type: str):
         "GroupNormalization",
         "LayerNormalization",
     ]
+)
+
+
+def is_normalization_op(op_type: str):
+    """Returns whether the given op type is of Normalization category or not."""
+    return op_type in _NORMALIZATION_OPS
+
+
+_CONVERSION_OPS = frozenset(["Cast", "QuantizeLinear", "DequantizeLinear"])
 
 
 def is_conversion_op(op_type: str):
     """Returns whether the given op type is of Conversion category or not."""
-    return op_type in ["Cast", "QuantizeLinear", "DequantizeLinear"]
+    return op_type in _CONVERSION_OPS
+
+
+_NON_RESHAPE_COPY_OPS = _COPY_OPS - {"Reshape"}
 
 
 def is_non_reshape_copy_op(op_type: str):
     """Returns whether the given op is a non-reshape copy op or not."""
-    return is_copy_op(op_type) and (op_type != "Reshape")
+    return op_type in _NON_RESHAPE_COPY_OPS
 
 
-def is_irregular_mem_access_op(op_type: str):
-    """Returns whether the given op type is of Irreggular mem access category or not."""
-    return op_type in [
+_IRREGULAR_MEM_ACCESS_OPS = frozenset(
+    [
         "Gather",
         "GatherElements",
         "GatherND",
@@ -165,11 +206,16 @@ def is_irregular_mem_access_op(op_type: str):
         "ScatterElements",
         "NonMaxSuppression",
     ]
+)
 
 
-def is_generator_op(op_type: str):
-    """Returns whether the given op type is of Generator category or not."""
-    return op_type in [
+def is_irregular_mem_access_op(op_type: str):
+    """Returns whether the given op type is of Irreggular mem access category or not."""
+    return op_type in _IRREGULAR_MEM_ACCESS_OPS
+
+
+_GENERATOR_OPS = frozenset(
+    [
         "Const",
         "ConstOfShape",
         "EyeLike",
@@ -179,11 +225,16 @@ def is_generator_op(op_type: str):
         "RandomUniform",
         "Bernoulli",
     ]
+)
 
 
-def is_modifier_op(op_type: str):
-    """Returns whether the given op type is of Modifier category or not."""
-    return op_type in [
+def is_generator_op(op_type: str):
+    """Returns whether the given op type is of Generator category or not."""
+    return op_type in _GENERATOR_OPS
+
+
+_MODIFIER_OPS = frozenset(
+    [
         "Identity",
         "Trilu",
         "Expand",
@@ -193,11 +244,16 @@ def is_modifier_op(op_type: str):
         "Col2Im",
         "MaxUnpool",
     ]
+)
 
 
-def is_sequence_op(op_type: str):
-    """Returns whether the given op type is of Sequence category or not."""
-    return op_type in [
+def is_modifier_op(op_type: str):
+    """Returns whether the given op type is of Modifier category or not."""
+    return op_type in _MODIFIER_OPS
+
+
+_SEQUENCE_OPS = frozenset(
+    [
         "SequenceAt",
         "SequenceConstruct",
         "SequenceEmpty",
@@ -205,42 +261,56 @@ def is_sequence_op(op_type: str):
         "SequenceInsert",
         "SequenceLength",
     ]
+)
+
+
+def is_sequence_op(op_type: str):
+    """Returns whether the given op type is of Sequence category or not."""
+    return op_type in _SEQUENCE_OPS
+
+
+_SELECTION_OPS = frozenset(["Where", "Compress"])
 
 
 def is_selection_op(op_type: str):
     """Returns whether the given op type is of Selection category or not."""
-    return op_type in ["Where", "Compress"]
+    return op_type in _SELECTION_OPS
+
+
+_CONTROL_FLOW_OPS = frozenset(["If", "Loop"])
 
 
 def is_control_flow_op(op_type: str):
     """Returns whether the given op type is of Control Flow category or not."""
-    return op_type in ["If", "Loop"]
+    return op_type in _CONTROL_FLOW_OPS
+
+
+_MULTICLASS_OPS = frozenset(["Einsum"])
 
 
 def is_multiclass_op(op_type: str):
     """Returns whether the given op type is of Multiclass category or not."""
-    return op_type in ["Einsum"]
+    return op_type in _MULTICLASS_OPS
+
+
+_RECURRENT_OPS = frozenset(["LSTM", "RNN", "GRU"])
 
 
 def is_recurrent_op(op_type: str):
     """Returns whether the given op type is of Recurrent category or not."""
-    return op_type in ["LSTM", "RNN", "GRU"]
+    return op_type in _RECURRENT_OPS
+
+
+_SHAPE_OPS = frozenset(["Shape", "Size"])
 
 
 def is_shape_op(op_type: str):
     """Returns whether the given op type is of Shape category or not."""
-    return op_type in ["Shape", "Size"]
+    return op_type in _SHAPE_OPS
 
 
-def is_default_quantizable_op_by_ort(op_type: str):
-    """Returns if ORT quantizes the op type by default.
-
-    Note. Subject to change with different ORT versions.
-    Note. Users can use nodes_to_quantize and/or op_types_to_quantize arguments to quantize
-    non-default operations.
-    Reference: https://github.com/microsoft/onnxruntime/blob/main/onnxruntime/python/tools/quantization/registry.py
-    """
-    return op_type in [
+_DEFAULT_QUANTIZABLE_OPS_BY_ORT = frozenset(
+    [
         "Conv",
         "Gemm",
         "ArgMax",
@@ -269,3 +339,15 @@ def is_default_quantizable_op_by_ort(op_type: str):
         "LeakyRelu",
         "AveragePool",
     ]
+)
+
+
+def is_default_quantizable_op_by_ort(op_type: str):
+    """Returns if ORT quantizes the op type by default.
+
+    Note. Subject to change with different ORT versions.
+    Note. Users can use nodes_to_quantize and/or op_types_to_quantize arguments to quantize
+    non-default operations.
+    Reference: https://github.com/microsoft/onnxruntime/blob/main/onnxruntime/python/tools/quantization/registry.py
+    """
+    return op_type in _DEFAULT_QUANTIZABLE_OPS_BY_ORT
@@ -13,14 +13,13 @@
 import logging
 import os
 import tempfile
-from typing import List
+from typing import Dict, List
 
 import numpy as np
 import onnx
 import onnx_graphsurgeon as gs
 from onnx import numpy_helper
 from onnx_graphsurgeon.ir.graph import Graph
-from onnxmltools.utils.float16_converter import convert_float_to_float16
 from onnxruntime.quantization import (
     CalibrationMethod,
     quantize_static,
@@ -35,6 +34,8 @@ from modelopt.onnx.quantization.graph_utils import (
 )
 from modelopt.onnx.quantization.ort_utils import configure_ort
 
+_QDQ_OP_TYPES = frozenset(["QuantizeLinear", "DequantizeLinear"])
+
 
 def _find_unsupported_fp8_convs_to_exclude(graph: Graph):
     """Find unsupported FP8 Conv nodes to exclude.
@@ -52,17 +53,16 @@ def _find_unsupported_fp8_convs_to_exclude(graph: Graph):
     unsupported_conv_nodes = []
     for node in graph.nodes:
         if node.op == "Conv":
-            weight = node.inputs[1]
-            output_channel = weight.shape[0]
-            input_channel = weight.shape[1]
+            weight_shape = node.inputs[1].shape
+            output_channel, input_channel = weight_shape[0], weight_shape[1]
             if output_channel % 16 != input_channel % 16:
                 logging.info(f"Found unpaddable conv for FP8: {node.name}")
                 unsupported_conv_nodes.append(node.name)
                 continue
 
-            filter_size = weight.shape[2] * weight.shape[3]
-            if len(weight.shape) == 5:
-                filter_size *= weight.shape[4]
+            filter_size = weight_shape[2] * weight_shape[3]
+            if len(weight_shape) == 5:
+                filter_size *= weight_shape[4]
             if filter_size > 32:
                 logging.info(f"Found large filter conv for FP8: {node.name}")
                 unsupported_conv_nodes.append(node.name)
@@ -85,56 +85,62 @@ def int8_to_fp8(onnx_path: str, verbose: bool = False) -> onnx.onnx_pb.ModelProt
     onnx_model = onnx.load(onnx_path)
     graph = onnx_model.graph
     initializers = graph.initializer
-    tensor_producers = get_tensor_producer_nodes(graph)
-    processed_tensor = set()
-
-    def _get_initializer_index(name: str):
-        for idx, init in enumerate(initializers):
-            if init.name == name:
-                return idx
-
-    def _int8_scale_to_fp8_scale(scale: np.ndarray, scale_name: str):
-        np_scale = onnx.numpy_helper.to_array(scale)
-        np_fp8_scale = (np_scale * 448.0) / 127.0
-        dtype = onnx.helper.tensor_dtype_to_np_dtype(scale.data_type)
-        return numpy_helper.from_array(np_fp8_scale.astype(dtype), scale_name)
-
-    def _convert(node: onnx.onnx_ml_pb2.NodeProto):
-        if verbose:
-            logging.info(f"Processing {node.name}")
-
-        scale_name = node.input[1]
-        zero_point_name = node.input[2]
-
-        if scale_name not in processed_tensor:
-            scale_idx = _get_initializer_index(scale_name)
-            if scale_idx is not None:
-                scale = initializers[scale_idx]
-                fp8_scale = _int8_scale_to_fp8_scale(scale, scale_name)
-                initializers[scale_idx].CopyFrom(fp8_scale)
-            else:
-                producer_node = tensor_producers[scale_name]
-                scale = producer_node.attribute[0].t
-                fp8_scale = _int8_scale_to_fp8_scale(scale, scale_name)
-                producer_node.attribute[0].t.CopyFrom(fp8_scale)
-            processed_tensor.add(scale_name)
-
-        if zero_point_name not in processed_tensor:
-            zero_point_idx = _get_initializer_index(zero_point_name)
-            zero_point = initializers[zero_point_idx]
-            dtype = onnx.helper.tensor_dtype_to_np_dtype(zero_point.data_type)
-            vals = np.array(zero_point.int32_data, dtype=dtype).tolist()
-
-            np_zero_point = onnx.helper.make_tensor(
-                zero_point_name, onnx.TensorProto.FLOAT8E4M3FN, zero_point.dims, vals
+    initializer_indices = {init.name: idx for idx, init in enumerate(initializers)}
+
+    def _int8_scales_to_fp8_scales(scales: Dict[str, onnx.TensorProto]):
+        # Convert all scales of the same dtype in one vectorized pass instead of one per tensor
+        np_scales = {name: numpy_helper.to_array(scale) for name, scale in scales.items()}
+        for dtype in {np_scale.dtype for np_scale in np_scales.values()}:
+            names = [name for name, np_scale in np_scales.items() if np_scale.dtype == dtype]
+            flat_scales = np.concatenate([np_scales[name].ravel() for name in names])
+            np_fp8_scales = ((flat_scales * 448.0) / 127.0).astype(dtype)
+            split_indices = np.cumsum([np_scales[name].size for name in names])[:-1]
+            for name, np_fp8_scale in zip(names, np.split(np_fp8_scales, split_indices)):
+                np_fp8_scale = np_fp8_scale.reshape(np_scales[name].shape)
+                scales[name].CopyFrom(numpy_helper.from_array(np_fp8_scale, name))
+
+    def _convert_zero_point(zero_point_name: str):
+        zero_point = initializers[initializer_indices[zero_point_name]]
+        np_zero_point = numpy_helper.to_array(zero_point)
+        if np.any(np_zero_point):
+            fp8_zero_point = onnx.helper.make_tensor(
+                zero_point_name,
+                onnx.TensorProto.FLOAT8E4M3FN,
+                zero_point.dims,
+                np_zero_point.flatten().tolist(),
             )
-            initializers[zero_point_idx].CopyFrom(np_zero_point)
-            processed_tensor.add(zero_point_name)
+            zero_point.CopyFrom(fp8_zero_point)
+            return
 
-    # Iterate through the nodes and convert the scales and zero points
+        # Max calibration is symmetric, so the zero points are all 0 which is also 0x00 in FP8.
+        # Write the raw bytes directly instead of converting the values one by one.
+        zero_point.ClearField("int32_data")
+        zero_point.data_type = onnx.TensorProto.FLOAT8E4M3FN
+        zero_point.raw_data = bytes(np_zero_point.size)
+
+    # Collect the unique scales and zero points of all Q/DQ nodes in a single pass over the nodes
+    scale_names, zero_point_names = {}, {}
     for node in graph.node:
-        if node.op_type in ["DequantizeLinear", "QuantizeLinear"]:
-            _convert(node)
+        if node.op_type in _QDQ_OP_TYPES:
+            if verbose:
+                logging.info(f"Processing {node.name}")
+            scale_names[node.input[1]] = None
+            zero_point_names[node.input[2]] = None
+
+    # Scales are either initializers or the value of a Constant node
+    tensor_producers = get_tensor_producer_nodes(graph)
+    scales = {
+        name: (
+            initializers[initializer_indices[name]]
+            if name in initializer_indices
+            else tensor_producers[name].attribute[0].t
+        )
+        for name in scale_names
+    }
+    _int8_scales_to_fp8_scales(scales)
+
+    for zero_point_name in zero_point_names:
+        _convert_zero_point(zero_point_name)
 
     return onnx_model
 
@@ -163,8 +169,9 @@ def quantize(
     if calibration_method != "max":
         raise RuntimeError("Only the max calibration method is supported for FP8 quantization.")
 
-    # Load the onnx graph
-    onnx_model = onnx.load(onnx_path, load_external_data=use_external_data_format)
+    # Load the onnx graph. Only the graph structure and tensor shapes are needed to select the
+    # nodes to quantize, and quantize_static reads the weights from onnx_path on its own.
+    onnx_model = onnx.load(onnx_path, load_external_data=False)
     graph = gs.import_onnx(onnx_model)
     graph.toposort()
 
@@ -231,6 +238,9 @@ def quantize(
     onnx_model = int8_to_fp8(tmp_onnx_path, verbose)
 
     if high_precision_dtype == "fp16":
+        # onnxmltools is slow to import and only needed here, so import it on first use.
+        from onnxmltools.utils.float16_converter import convert_float_to_float16
+
         # We need to convert float to float16 so as to speed up layers like LayerNorm or GroupNorm.
         logging.info("Converting float tensors to float16")
         onnx_model = convert_float_to_float16(
@@ -13,8 +13,8 @@
 import logging
 import os
 import re
-from collections import defaultdict
-from typing import Dict, List, Optional, Tuple
+from collections import Counter, defaultdict
+from typing import Dict, FrozenSet, List, Optional, Tuple
 
 import numpy as np
 import onnx
@@ -32,48 +32,85 @@ from modelopt.onnx.utils import (
 )
 
 
-def is_const_input(tensor: Tensor) -> bool:
-    """Returns whether the given tensor is an initializer or produced by const-foldable nodes."""
-    if isinstance(tensor, Constant):
-        return True
-
-    # Tensor is a graph input variable
-    if len(tensor.inputs) == 0:
-        return False
+def is_const_input(tensor: Tensor, const_cache: Optional[Dict[int, bool]] = None) -> bool:
+    """Returns whether the given tensor is an initializer or produced by const-foldable nodes.
 
-    producer_node = tensor.inputs[0]  # Generally tensors has single producer
-    if producer_node.op in ["Constant", "Identity"]:
-        return True
+    Args:
+        tensor: Tensor to check.
+        const_cache: Optional memo of results keyed by tensor id. Pass the same dict across the calls
+            of a single graph pass to avoid re-walking the producers of shared tensors. It must not
+            outlive modifications to the graph.
+    """
+    # Tensors on the walked Squeeze/Unsqueeze chain, they all share the result
+    walked_tensors = []
+    while True:
+        if const_cache is not None and id(tensor) in const_cache:
+            is_const = const_cache[id(tensor)]
+            break
+        walked_tensors.append(tensor)
+
+        if isinstance(tensor, Constant):
+            is_const = True
+            break
+
+        # Tensor is a graph input variable
+        if len(tensor.inputs) == 0:
+            is_const = False
+            break
+
+        producer_node = tensor.inputs[0]  # Generally tensors has single producer
+        if producer_node.op in ["Constant", "Identity"]:
+            is_const = True
+            break
+
+        # Second axes input to Squeeze/Unsqueeze is a constant, we need to check the first input
+        if producer_node.op in ["Squeeze", "Unsqueeze"]:
+            tensor = producer_node.inputs[0]
+            continue
 
-    # Second axes input to Squeeze/Unsqueeze is a constant, we need to check the first input
-    if producer_node.op in ["Squeeze", "Unsqueeze"] and is_const_input(producer_node.inputs[0]):
-        return True
+        # Const -> Clip -> Exp -> Mul pattern matching for swin_v2
+        is_const = False
+        if producer_node.op == "Exp":
+            clip_node = producer_node.i()
+            is_const = clip_node.op == "Clip" and has_const_input(clip_node, const_cache)
+        break
 
-    # Const -> Clip -> Exp -> Mul pattern matching for swin_v2
-    if producer_node.op == "Exp":
-        clip_node = producer_node.i()
-        if clip_node.op == "Clip" and has_const_input(clip_node):
-            return True
+    if const_cache is not None:
+        for walked_tensor in walked_tensors:
+            const_cache[id(walked_tensor)] = is_const
+    return is_const
 
-    return False
 
+def has_const_input(node: Node, const_cache: Optional[Dict[int, bool]] = None) -> bool:
+    """Returns whether the given node has any constant input.
 
-def has_const_input(node: Node) -> bool:
-    """Returns whether the given node has any constant input."""
+    See :func:`is_const_input` for ``const_cache``.
+    """
     for tensor in node.inputs:
-        if is_const_input(tensor):
+        if is_const_input(tensor, const_cache):
             return True
 
     return False
 
 
+# Optional path types and the op types they are converted from when the node has a const input
+_OPTIONAL_PATH_TYPES = frozenset(["BiasAdd", "ConstMul"])
+_CONST_INPUT_PATH_TYPES = {"Add": "BiasAdd", "Mul": "ConstMul"}
+
+# Op types skipped while matching the MatMul -> Softmax -> MatMul chains of MHA
+_MHA_WILD_CARD_TYPES = frozenset(
+    ["Div", "Mul", "ConstMul", "Add", "BiasAdd", "Reshape", "Transpose", "Flatten", "Cast"]
+)
+
+
 def has_path_type(
     node: Node,
     graph: Graph,
     path_type: List[str],
     is_forward: bool,
-    wild_card_types: List[str] = [],
-    path_nodes: List[Node] = [],
+    wild_card_types: Optional[List[str]] = None,
+    path_nodes: Optional[List[Node]] = None,
+    const_cache: Optional[Dict[int, bool]] = None,
 ) -> bool:
     """Checks if the given node is start/end of a given forward/backward path type.
 
@@ -87,28 +124,34 @@ def has_path_type(
         is_forward: Whether to match forward or backward path.
         wild_card_types: Wild card types, these type of nodes are skipped and not matched with the path_type.
         path_nodes: Accumulated nodes in the matched path.
+        const_cache: Optional memo for constant input checks, see :func:`is_const_input`.
 
     Returns:
         Bool, whether the given node is start/end of the given forward/backward path type.
     """
-    optional_path_types = ["BiasAdd", "ConstMul"]
+    wild_card_types = wild_card_types or []
+    if path_nodes is None:
+        path_nodes = []
+
     if not path_type:
         # All types matched
         return True
 
     # Current node type and special type conversion for optional BiasAdd and ConstMul
     # Note, matching path with Add/Mul type nodes with const input will fail
+    # The conversion can only change the outcome against optional or wild card types
     node_type = node.op
-    if node_type == "Add" and has_const_input(node):
-        node_type = "BiasAdd"
-    elif node_type == "Mul" and has_const_input(node):
-        node_type = "ConstMul"
+    if node_type in _CONST_INPUT_PATH_TYPES and (
+        wild_card_types or path_type[0] in _OPTIONAL_PATH_TYPES
+    ):
+        if has_const_input(node, const_cache):
+            node_type = _CONST_INPUT_PATH_TYPES[node_type]
 
     # Check if current non-wild node type does not match the expected path type
     # And if path type is not optional (ex. BiasAdd)
     is_match = (node_type == path_type[0]) or (node.op == path_type[0])
     is_wild_match = node_type in wild_card_types
-    if not is_match and not is_wild_match and (path_type[0] not in optional_path_types):
+    if not is_match and not is_wild_match and (path_type[0] not in _OPTIONAL_PATH_TYPES):
         return False
 
     # Add current node name in the path
@@ -117,16 +160,16 @@ def has_path_type(
 
     # If current node type matches the expected path type or path type is optional (ex. BiasAdd), we have a type match
     # Update the remaining path types to match
-    next_path_type = path_type[:]
+    next_path_type = path_type
 
     # Non-repeatable optional types should be consumed
-    if is_match or (path_type[0] in ["BiasAdd", "ConstMul"]):
+    if is_match or (path_type[0] in _OPTIONAL_PATH_TYPES):
         next_path_type = path_type[1:]
 
     # If current node is not wild card and didn't match, go ahead and match with the
     # remaining path types starting with the current node
     if not is_match and not is_wild_match:
-        assert path_type[0] in optional_path_types
+        assert path_type[0] in _OPTIONAL_PATH_TYPES
         return has_path_type(
             node,
             graph,
@@ -134,6 +177,7 @@ def has_path_type(
             is_forward,
             wild_card_types,
             path_nodes,
+            const_cache,
         )
 
     if is_forward:
@@ -144,7 +188,9 @@ def has_path_type(
     # Check if any child (forward path) or parent (backward path) can match the remaining path types
     for next_node in next_level_nodes:
         sub_path = []
-        if has_path_type(next_node, graph, next_path_type, is_forward, wild_card_types, sub_path):
+        if has_path_type(
+            next_node, graph, next_path_type, is_forward, wild_card_types, sub_path, const_cache
+        ):
             path_nodes.extend(sub_path)
             return True
 
@@ -152,7 +198,31 @@ def has_path_type(
     return not next_path_type
 
 
-def get_fusible_backbone(node: Node, graph: Graph) -> Optional[Node]:
+def _has_path_type_cached(
+    node: Node,
+    graph: Graph,
+    path_type: List[str],
+    is_forward: bool,
+    wild_card_types: List[str],
+    path_cache: Dict[Tuple, bool],
+    const_cache: Optional[Dict[int, bool]] = None,
+) -> bool:
+    """Memoized :func:`has_path_type` for callers that do not need the matched path nodes."""
+    key = (id(node), tuple(path_type), is_forward, tuple(wild_card_types))
+    if key not in path_cache:
+        path_cache[key] = has_path_type(
+            node, graph, path_type, is_forward, wild_card_types, [], const_cache
+        )
+    return path_cache[key]
+
+
+def get_fusible_backbone(
+    node: Node,
+    graph: Graph,
+    const_cache: Optional[Dict[int, bool]] = None,
+    path_cache: Optional[Dict[Tuple, bool]] = None,
+    backbone_cache: Optional[Dict[int, Optional[Node]]] = None,
+) -> Optional[Node]:
     """Returns the linear backbone node for a given node if it matches the pattern.
 
     TensorRT fuses convolution with BN, Relu etc. when in some specific pattern.
@@ -162,21 +232,37 @@ def get_fusible_backbone(node: Node, graph: Graph) -> Optional[Node]:
     Args:
         node: Start node of the pattern.
         graph: ONNX model graph.
+        const_cache: Optional memo for constant input checks, see :func:`is_const_input`.
+        path_cache: Optional memo of path type matches. Share it across the calls of a single graph
+            pass when the same nodes are queried repeatedly.
+        backbone_cache: Optional memo of the results keyed by node id, shared the same way.
 
     Returns:
         Backbone node of the given node, None if not found.
     """
+    if backbone_cache is not None and id(node) in backbone_cache:
+        return backbone_cache[id(node)]
+
+    # Backbones already searched from a node, avoids re-walking reconvergent branches
+    searched_backbones = {}
 
     def _get_backbone(root: Node):
+        if id(root) in searched_backbones:
+            return searched_backbones[id(root)]
+
+        bb = None
         if root.op == "Conv":
-            return root
+            bb = root
+        else:
+            for tensor in root.inputs:
+                if not isinstance(tensor, Constant):
+                    parent_node = tensor.inputs[0]
+                    bb = _get_backbone(parent_node)
+                    if bb:
+                        break
 
-        for tensor in root.inputs:
-            if not isinstance(tensor, Constant):
-                parent_node = tensor.inputs[0]
-                bb = _get_backbone(parent_node)
-                if bb:
-                    return bb
+        searched_backbones[id(root)] = bb
+        return bb
 
     fusible_linear_path_types = [
         # ["Sigmoid", "Conv"],  # With following Mul
@@ -186,11 +272,17 @@ def get_fusible_backbone(node: Node, graph: Graph) -> Optional[Node]:
         ["BatchNormalization", "BiasAdd", "Conv"],
         ["Relu", "BatchNormalization", "BiasAdd", "Conv"],
     ]
-    for idx, path_type in enumerate(fusible_linear_path_types):
-        if has_path_type(node, graph, path_type, is_forward=False, wild_card_types=[]):
-            return _get_backbone(node)
+    if path_cache is None:
+        path_cache = {}
+    backbone = None
+    for path_type in fusible_linear_path_types:
+        if _has_path_type_cached(node, graph, path_type, False, [], path_cache, const_cache):
+            backbone = _get_backbone(node)
+            break
 
-    return None
+    if backbone_cache is not None:
+        backbone_cache[id(node)] = backbone
+    return backbone
 
 
 def get_tensor_producer_nodes(
@@ -207,6 +299,19 @@ def get_tensor_producer_nodes(
         Dictionary, key is tensor name and value is their producer node object
     """
     # Create a dictionary to store tensor producer nodes
+    tensor_producers = _get_root_producers(graph)
+
+    # Traverse the graph to find producer nodes for each tensor
+    for node in graph.node:
+        for output_name in node.output:
+            tensor_producers[output_name] = node
+
+    return tensor_producers
+
+
+def _get_root_producers(
+    graph: onnx.onnx_ml_pb2.GraphProto,
+) -> Dict[str, onnx.onnx_ml_pb2.NodeProto]:
     tensor_producers = defaultdict(None)
 
     # Special Root type producer node
@@ -217,20 +322,16 @@ def get_tensor_producer_nodes(
         name="root_0",
     )
 
-    input_names = [graph_input.name for graph_input in graph.input]
-    initializer_names = [initializer.name for initializer in graph.initializer]
-    external_input_names = list(np.setdiff1d(input_names, initializer_names))
+    initializer_names = {initializer.name for initializer in graph.initializer}
+    external_input_names = [
+        graph_input.name for graph_input in graph.input if graph_input.name not in initializer_names
+    ]
 
     # Note. We are marking external inputs as non-constant by adding a parent,
     # so that we can quantize the first node of the graph if appropriate
     for graph_input in external_input_names:
         tensor_producers[graph_input] = root_node
 
-    # Traverse the graph to find producer nodes for each tensor
-    for node in graph.node:
-        for output_name in node.output:
-            tensor_producers[output_name] = node
-
     return tensor_producers
 
 
@@ -256,46 +357,71 @@ def get_tensor_consumer_nodes(
     return tensor_consumers
 
 
+def get_tensor_producer_and_consumer_nodes(
+    graph: onnx.onnx_ml_pb2.GraphProto,
+) -> Tuple[
+    Dict[str, onnx.onnx_ml_pb2.NodeProto], Dict[str, List[onnx.onnx_ml_pb2.NodeProto]]
+]:
+    """Returns both tensor producer and consumer node mappings from a single pass over the graph.
+
+    See :func:`get_tensor_producer_nodes` and :func:`get_tensor_consumer_nodes` for the mappings.
+
+    Args:
+        graph: ONNX model graph.
+
+    Returns:
+        Dictionary of tensor name and their producer node object.
+        Dictionary of tensor name and their consumer node objects.
+    """
+    tensor_producers = _get_root_producers(graph)
+    tensor_consumers = defaultdict(list)
+
+    for node in graph.node:
+        for output_name in node.output:
+            tensor_producers[output_name] = node
+        for input_name in node.input:
+            tensor_consumers[input_name].append(node)
+
+    return tensor_producers, tensor_consumers
+
+
 def filter_quantizable_kgen_heads(
     cask_fusible_partitions: List[List[Node]],
     kgen_partitions: List[List[Node]],
     quantizable_op_types: List[str],
 ) -> Tuple[List[Node], List[Tuple[Node, Node, str]]]:
     """Returns the list of kgen head names if it follows a CASK partition."""
-    cask_partition_nodes = set()
-    for partition in cask_fusible_partitions:
-        cask_partition_nodes.update([node.name for node in partition])
+    cask_partition_nodes = {node.name for partition in cask_fusible_partitions for node in partition}
 
-    cask_partition_heads = [partition[0] for partition in cask_fusible_partitions]
+    # Names of the cask partition heads and the kgen heads found quantizable so far
+    quantizable_op_names = {partition[0].name for partition in cask_fusible_partitions}
+    const_cache = {}
 
     def _is_following_cask_partition(node: Node):
         # Checking if cask fusible partition can be reached backward
         # ignoring the copy ops
-        if node.name in cask_partition_nodes:
-            return True
-
-        if not is_copy_op(node.op):
-            return False
+        stack = [node]
+        visited = set()
+        while stack:
+            node = stack.pop()
+            if id(node) in visited:
+                continue
+            visited.add(id(node))
 
-        for parent in get_parent_nodes(node):
-            if _is_following_cask_partition(parent):
+            if node.name in cask_partition_nodes:
                 return True
 
+            if is_copy_op(node.op):
+                stack.extend(get_parent_nodes(node))
+
         return False
 
-    def _has_other_quantizable_consumer(
-        tensor: Tensor, quantizable_kgen_heads: List[Node], head_name: str
-    ):
+    def _has_other_quantizable_consumer(tensor: Tensor, head_name: str):
         # Note. this is kinda approximate analysis,
         # all quantizable kgen heads may haven't got discovered yet
-        quantizable_ops = [node.name for node in cask_partition_heads + quantizable_kgen_heads]
-
         # Look for other quantizable consumer than the current kgen head
-        if head_name in quantizable_ops:
-            quantizable_ops.remove(head_name)
-
         for consumer in tensor.outputs:
-            if consumer.name in quantizable_ops:
+            if consumer.name != head_name and consumer.name in quantizable_op_names:
                 return True
 
         return False
@@ -316,7 +442,7 @@ def filter_quantizable_kgen_heads(
             continue
 
         # If the node has cost input, do not quantize
-        if has_const_input(head_node):
+        if has_const_input(head_node, const_cache):
             continue
 
         head_parents = get_parent_nodes(head_node)
@@ -329,13 +455,14 @@ def filter_quantizable_kgen_heads(
         for parent in head_parents:
             # If the head is consuming output of any quantizable op, then it is quantizable
             if _is_following_cask_partition(parent) or parent.op in output_quantization_candidates:
-                quantizable_kgen_heads.append(partition[0])
+                # Collect the head once even if several of its inputs are quantizable
+                if not has_quantizable_input:
+                    quantizable_kgen_heads.append(head_node)
+                    quantizable_op_names.add(head_node.name)
                 has_quantizable_input = True
             # If the input from the current parent has no other quantizable consumer, do not quantize that input
-            elif not _has_other_quantizable_consumer(
-                parent.outputs[0], quantizable_kgen_heads, head_node.name
-            ):
-                no_quantize_inputs_of_head.append((parent, partition[0], parent.outputs[0].name))
+            elif not _has_other_quantizable_consumer(parent.outputs[0], head_node.name):
+                no_quantize_inputs_of_head.append((parent, head_node, parent.outputs[0].name))
 
         # If at least one input of Add is quantizable, collect if there is any non-quantizable inputs
         if head_node.op == "Add" and has_quantizable_input:
@@ -360,22 +487,22 @@ def classify_partition_nodes(
     non_quantizable_partition_nodes = []  # list of Node [node1, ...]
     quantizable_partition_nodes = []  # list of Node [node1, ...]
     no_quantize_inputs = []  # list of tuple [(src_node, dst_node, input_name), ...]
+    const_cache = {}
 
     for partition in partitions:
         partition_root_type = partition[0].op
         assert is_linear_op(partition_root_type)
 
         # Collect tensor names produced by partition nodes
-        partition_node_outputs = []
-        for node in partition:
-            for node_output in node.outputs:
-                partition_node_outputs.append(node_output.name)
+        partition_node_outputs = {
+            node_output.name for node in partition for node_output in node.outputs
+        }
 
         for node in partition:
             has_external_inputs = False
             internal_inputs = []  # Keeps (producer, consumer, tensor)
             for tensor in node.inputs:
-                if is_const_input(tensor):
+                if is_const_input(tensor, const_cache):
                     continue
 
                 # If a KGEN op has external non-constant input, it is considered partially quantizable
@@ -416,13 +543,16 @@ def build_non_residual_input_map(graph: Graph) -> Dict[str, str]:
         Dictionary of Add node names vs their non-residual input name.
     """
     non_residual_inputs = {}
+    const_cache = {}
+    path_cache = {}
+    backbone_cache = {}
     for node in graph.nodes:
         if node.op in ["Add"]:
             # Add nodes with constant or graph input does not have non-residual input
             # Here, A = node.inputs[0], B = node.inputs[1] and A.inputs means producer nodes of A
             # TODO: make this check a util?
             if (
-                has_const_input(node)
+                has_const_input(node, const_cache)
                 or len(node.inputs[0].inputs) == 0
                 or len(node.inputs[1].inputs) == 0
             ):
@@ -432,8 +562,12 @@ def build_non_residual_input_map(graph: Graph) -> Dict[str, str]:
             input1_producer = node.i(0, 0)
             input2_producer = node.i(1, 0)
 
-            backbone1 = get_fusible_backbone(input1_producer, graph)
-            backbone2 = get_fusible_backbone(input2_producer, graph)
+            backbone1 = get_fusible_backbone(
+                input1_producer, graph, const_cache, path_cache, backbone_cache
+            )
+            backbone2 = get_fusible_backbone(
+                input2_producer, graph, const_cache, path_cache, backbone_cache
+            )
 
             # Generally if both the inputs have a backbone then both backbones are of the same type
             if backbone1 and backbone2:
@@ -487,12 +621,14 @@ def remove_partial_input_qdq(
             dq_node = dq_node.outputs[0]  # source_node->Q->DQ->target_node
             while len(dq_node.outputs):
                 # Find the input index in the target connecting with source_node
-                target_input_idx_arr = [
-                    idx
-                    for idx, inp in enumerate(dq_node.outputs[0].inputs)
-                    if inp.name == dq_node.name
-                ]
-                target_input_idx = target_input_idx_arr[0] if target_input_idx_arr else 0
+                target_input_idx = next(
+                    (
+                        idx
+                        for idx, inp in enumerate(dq_node.outputs[0].inputs)
+                        if inp is dq_node
+                    ),
+                    0,
+                )
 
                 # Connect the output of source_node with the outputs of DQ until DQ is not connected to any other
                 #   layers. Note that when a connection is removed, this is also deleted from dq_node.outputs, thus
@@ -512,25 +648,104 @@ def _find_nodes_from_op_types_to_exclude(graph: Graph, op_types_to_exclude=None)
 
 def expand_node_names_from_patterns(graph: Graph, name_patterns: List[str]) -> List[str]:
     """Expand the node names from the given patterns."""
-    matched_node_names = []
-    for pattern in name_patterns:
-        for node in graph.nodes:
-            if re.match(pattern, node.name):
-                matched_node_names.append(node.name)
+    if not name_patterns:
+        return []
 
-    return matched_node_names
+    # Match all patterns in a single pass over the nodes
+    combined_pattern = re.compile("|".join(f"(?:{pattern})" for pattern in name_patterns))
+    return [node.name for node in graph.nodes if combined_pattern.match(node.name)]
 
 
 def find_nodes_to_exclude(
     graph: Graph, nodes_to_exclude: List[str], op_types_to_exclude: List[str]
 ):
     """Find the node names from the ONNX graph which matches user's exclusion patterns."""
+    if not nodes_to_exclude and not op_types_to_exclude:
+        return []
+
     nodes_to_exclude = nodes_to_exclude or []
     nodes_to_exclude = expand_node_names_from_patterns(graph, nodes_to_exclude)
     nodes_to_exclude.extend(_find_nodes_from_op_types_to_exclude(graph, op_types_to_exclude))
 
     # Remove duplicates from the exclusion list
-    return [*set(nodes_to_exclude)]
+    return list(dict.fromkeys(nodes_to_exclude))
+
+
+def _get_static_tensor_shapes(
+    model: onnx.onnx_ml_pb2.ModelProto, tensor_names: List[str]
+) -> Dict[str, List[int]]:
+    """Returns the shapes of the given tensors whose last two dims are static after shape inference."""
+    try:
+        inferred_model = onnx.shape_inference.infer_shapes(model)
+    except Exception as e:
+        logging.info(f"Shape inference failed, falling back to model's inference: {e}")
+        return {}
+
+    value_infos = {
+        value_info.name: value_info
+        for value_info in [*inferred_model.graph.value_info, *inferred_model.graph.output]
+    }
+    tensor_shapes = {}
+    for name in tensor_names:
+        if name not in value_infos:
+            continue
+        dims = value_infos[name].type.tensor_type.shape.dim
+        if len(dims) >= 2 and all(d.HasField("dim_value") for d in dims[-2:]):
+            tensor_shapes[name] = [d.dim_value if d.HasField("dim_value") else -1 for d in dims]
+
+    return tensor_shapes
+
+
+def _get_tensor_shapes_from_inference(
+    model: onnx.onnx_ml_pb2.ModelProto,
+    onnx_path: str,
+    tensor_names: List[str],
+    use_external_data_format: bool,
+    intermediate_generated_files: List[str],
+) -> Dict[str, List[int]]:
+    """Returns the shapes of the given tensors by running the model with dummy inputs."""
+    # First, generate dummy inputs tensor for inference.
+    initializers = {initializer.name for initializer in model.graph.initializer}
+    inputs = {}
+    for node in model.graph.input:
+        if node.name not in initializers:
+            dim = node.type.tensor_type.shape.dim
+            input_shape = [int(d.dim_value) if d.dim_value else 1 for d in dim]
+            # Only the output shapes are used, so the input values do not matter
+            if node.type.tensor_type.elem_type == onnx.TensorProto.INT32:
+                inputs[node.name] = np.zeros(input_shape, dtype=np.int32)
+            elif node.type.tensor_type.elem_type == onnx.TensorProto.INT64:
+                inputs[node.name] = np.zeros(input_shape, dtype=np.int64)
+            elif node.type.tensor_type.elem_type == onnx.TensorProto.FLOAT16:
+                inputs[node.name] = np.zeros(input_shape, dtype=np.float16)
+            elif node.type.tensor_type.elem_type == onnx.TensorProto.FLOAT:
+                inputs[node.name] = np.zeros(input_shape, dtype=np.float32)
+            else:
+                logging.error(
+                    f"Input: {node.name} 's dtype {node.type.tensor_type.elem_type} is unsupported."
+                )
+
+    # Then, add the tensors as BS1 model's extended outputs and initialize ORT session.
+    extended_outputs = [onnx.ValueInfoProto(name=name) for name in tensor_names]
+    if use_external_data_format:
+        # Save only the protobuf next to onnx_path, so that its external data references still
+        # resolve to the original weights file and the weights are not written again.
+        extended_model = onnx.load(onnx_path, load_external_data=False)
+        extended_model.graph.output.extend(extended_outputs)
+        extended_onnx_path = f"{onnx_path[:-5]}.extended.onnx"
+        onnx.save_model(extended_model, extended_onnx_path)
+        intermediate_generated_files.append(extended_onnx_path)
+        session = create_inference_session(extended_onnx_path)
+    else:
+        # The outputs are removed again once the session is created as the model may be shared
+        # with the caller.
+        model.graph.output.extend(extended_outputs)
+        session = create_inference_session(model.SerializeToString())
+        del model.graph.output[-len(tensor_names) :]
+
+    # Run extended model's inference, fetching only the requested tensors.
+    outputs = session.run(tensor_names, inputs)
+    return {name: list(output.shape) for name, output in zip(tensor_names, outputs)}
 
 
 def find_nodes_from_mha_to_exclude(
@@ -540,6 +755,8 @@ def find_nodes_from_mha_to_exclude(
     disable_mha_qdq: bool = False,
     is_fp8fp16: bool = True,
     intermediate_generated_files: List[str] = None,
+    model: Optional[onnx.onnx_ml_pb2.ModelProto] = None,
+    graph: Optional[Graph] = None,
 ) -> List[str]:
     """Find MatMul nodes in MHA pattern to exclude.
 
@@ -562,92 +779,55 @@ def find_nodes_from_mha_to_exclude(
             If True, each MHA block will be checked whether to enable QDQ or not.
         intermediate_generated_files:
             List of intermediate generated files that will be deleted after quantization.
+        model:
+            Already loaded model at onnx_path. If None, the model is loaded from onnx_path.
+        graph:
+            Already imported graph of the model. If None, the graph is imported from the model.
 
     Returns:
         List of Nodes to exclude from quantization.
     """
-    model = onnx.load(onnx_path, load_external_data=use_external_data_format)
-    graph = gs.import_onnx(model)
+    if model is None:
+        # The weights are not needed to match the MHA patterns and infer the shapes
+        model = onnx.load(onnx_path, load_external_data=False)
+    if graph is None:
+        graph = gs.import_onnx(model)
 
     mha_partitions = find_mha_partitions(graph)
     if len(mha_partitions) == 0:
         return []
 
     if disable_mha_qdq:
-        for mha_partition in mha_partitions:
-            nodes_to_exclude.append(mha_partition[0].name)
-            nodes_to_exclude.append(mha_partition[2].name)
+        for bmm1_node, _, bmm2_node in mha_partitions:
+            nodes_to_exclude.append(bmm1_node.name)
+            nodes_to_exclude.append(bmm2_node.name)
     elif is_fp8fp16:
-        # To get head_size and seq_len of MHA, we need to run
-        # model's inference to get the shape info.
-        # First, generate random inputs tensor for inference.
-        initializers = [node.name for node in model.graph.initializer]
-        inputs = {}
-        for node in model.graph.input:
-            if node.name not in initializers:
-                dim = node.type.tensor_type.shape.dim
-                input_shape = [int(d.dim_value) if d.dim_value else 1 for d in dim]
-                if node.type.tensor_type.elem_type == onnx.TensorProto.INT32:
-                    inputs[node.name] = np.int32(np.random.randint(1, size=input_shape))
-                elif node.type.tensor_type.elem_type == onnx.TensorProto.INT64:
-                    inputs[node.name] = np.int64(np.random.randint(1, size=input_shape))
-                elif node.type.tensor_type.elem_type == onnx.TensorProto.FLOAT16:
-                    inputs[node.name] = np.float16(np.random.random(input_shape))
-                elif node.type.tensor_type.elem_type == onnx.TensorProto.FLOAT:
-                    inputs[node.name] = np.float32(np.random.random(input_shape))
-                else:
-                    logging.error(
-                        f"Input: {node.name} 's dtype {node.type.tensor_type.elem_type} is unsupported."
-                    )
-
-        # Then, add each BMM1's second input as BS1 model's extended outputs.
-        for mha_partition in mha_partitions:
-            bmm1_node = mha_partition[0]
-            model.graph.output.extend([onnx.ValueInfoProto(name=bmm1_node.inputs[1].name)])
-
-        # Initialize ORT session.
-        if use_external_data_format:
-            extended_onnx_path = f"{onnx_path[:-5]}.extended.onnx"
-            extended_model_external_data_path = f"{onnx_path[:-5]}.extended.onnx_data"
-            onnx.save_model(
-                model,
-                extended_onnx_path,
-                save_as_external_data=True,
-                location=os.path.basename(extended_model_external_data_path),
+        # To get head_size and seq_len of MHA, read the static shapes from shape inference
+        # and only run model's inference for the tensors whose shapes are dynamic.
+        bmm1_input_names = [bmm1_node.inputs[1].name for bmm1_node, _, _ in mha_partitions]
+        output_shapes = _get_static_tensor_shapes(model, bmm1_input_names)
+        dynamic_input_names = [name for name in bmm1_input_names if name not in output_shapes]
+        if dynamic_input_names:
+            output_shapes.update(
+                _get_tensor_shapes_from_inference(
+                    model,
+                    onnx_path,
+                    dynamic_input_names,
+                    use_external_data_format,
+                    intermediate_generated_files,
+                )
             )
-            intermediate_generated_files.append(extended_onnx_path)
-            intermediate_generated_files.append(extended_model_external_data_path)
-            session = create_inference_session(extended_onnx_path)
-        else:
-            session = create_inference_session(model.SerializeToString())
-
-        # Run extended model's inference.
-        extended_model_output_names = [output.name for output in session.get_outputs()]
-        outputs = session.run(extended_model_output_names, inputs)
-        output_map = {name: output for name, output in zip(extended_model_output_names, outputs)}
 
         maskadd_chain_type = ["MatMul", "Add", "Softmax"]
         reshape_add_reshape_chain_type = ["MatMul", "Reshape", "Add", "Reshape", "Softmax"]
-        wild_card_types = [
-            "Div",
-            "Mul",
-            "ConstMul",
-            "Add",
-            "BiasAdd",
-            "Reshape",
-            "Transpose",
-            "Flatten",
-            "Cast",
-        ]
+        wild_card_types = _MHA_WILD_CARD_TYPES
 
         # For each MHA block, if head_size % 16 != 0, add its bmm1 to nodes_to_exclude.
         # If head_size % 16 == 0 and MHA has maskadd, add bmm1 to nodes_to_exclude.
-        for mha_partition in mha_partitions:
-            bmm1_node = mha_partition[0]
-            bmm1_input_name = bmm1_node.inputs[1].name
-            bmm1_input = output_map[bmm1_input_name]
-            seq_len = bmm1_input.shape[-1]
-            head_size = bmm1_input.shape[-2]
+        for bmm1_node, _, bmm2_node in mha_partitions:
+            bmm1_input_shape = output_shapes[bmm1_node.inputs[1].name]
+            seq_len = bmm1_input_shape[-1]
+            head_size = bmm1_input_shape[-2]
             enable_mha_qdq = True
             maskadd_partition = []
             if has_path_type(
@@ -679,16 +859,20 @@ def find_nodes_from_mha_to_exclude(
                     enable_mha_qdq = False
 
             if not enable_mha_qdq:
-                nodes_to_exclude.append(mha_partition[0].name)
-                nodes_to_exclude.append(mha_partition[2].name)
+                nodes_to_exclude.append(bmm1_node.name)
+                nodes_to_exclude.append(bmm2_node.name)
 
     # Remove duplicates from the exclusion list
     return [*set(nodes_to_exclude)]
 
 
-def add_fp16_fp32_cast(onnx_path, custom_ops_to_cast_to_fp16):
-    """Adds cast_to_fp16 nodes to the inputs of a layer and cast_to_fp32 to the outputs."""
+def add_fp16_fp32_cast(onnx_path, custom_ops_to_cast_to_fp16, onnx_model=None):
+    """Adds cast_to_fp16 nodes to the inputs of a layer and cast_to_fp32 to the outputs.
+
+    If onnx_model is given, it is used instead of loading the model from onnx_path again.
+    """
     name_dict = {}
+    cast_nodes = []
 
     def _get_unique_name(old_name):
         if old_name not in name_dict:
@@ -717,7 +901,7 @@ def add_fp16_fp32_cast(onnx_path, custom_ops_to_cast_to_fp16):
             inputs=[tensor],
             outputs=[cast_out],
         )
-        graph.nodes.append(cast_node)
+        cast_nodes.append(cast_node)
         return cast_out
 
     def _add_cast_node_out(tensor, inp_precision="fp16", out_precision="fp32", suffix=""):
@@ -740,10 +924,13 @@ def add_fp16_fp32_cast(onnx_path, custom_ops_to_cast_to_fp16):
             inputs=[cast_inp],
             outputs=[tensor],
         )
-        graph.nodes.append(cast_node)
+        cast_nodes.append(cast_node)
         return cast_inp
 
-    graph = gs.import_onnx(onnx.load(onnx_path))
+    if onnx_model is None:
+        onnx_model = onnx.load(onnx_path)
+    graph = gs.import_onnx(onnx_model)
+    custom_ops_to_cast_to_fp16 = set(custom_ops_to_cast_to_fp16)
     castable_nodes = [n for n in graph.nodes if n.op in custom_ops_to_cast_to_fp16]
 
     for node in castable_nodes:
@@ -757,6 +944,7 @@ def add_fp16_fp32_cast(onnx_path, custom_ops_to_cast_to_fp16):
             cast_inp = _add_cast_node_out(out)
             node.outputs[out_idx] = cast_inp
 
+    graph.nodes.extend(cast_nodes)
     graph.cleanup().toposort()
 
     new_onnx_path = onnx_path.replace(".onnx", "_castFP16.onnx")
@@ -766,25 +954,21 @@ def add_fp16_fp32_cast(onnx_path, custom_ops_to_cast_to_fp16):
 
 def print_stat(graph: Graph, verbose: bool) -> None:
     """Collect and print stats of the quantized model."""
-    count = 0
-    quantized_type_counts = {}
-    quantized_nodes = []
-    output_names = [output_node.name for output_node in graph.outputs]
-    for node in graph.nodes:
-        for tensor in node.inputs:
-            if len(tensor.inputs) == 0:
-                continue
-
-            producer_node = tensor.inputs[0]
-            if producer_node.op == "DequantizeLinear":
-                quantized_type_counts[node.op] = quantized_type_counts.get(node.op, 0) + 1
-                quantized_nodes.append(node.name)
-                count += 1
-                break
-            else:
-                # Sometimes "_DequantizeLinear_Output" is not suffix of the "DequantizeLinear" typed node,
-                # if that node is also in final model output. Ex. CLIP-ViT-L-14-opset16.onnx
-                assert tensor.name in output_names or producer_node.op != "DequantizeLinear"
+    dq_output_names = {
+        tensor.name
+        for node in graph.nodes
+        if node.op == "DequantizeLinear"
+        for tensor in node.outputs
+    }
+    # A node is quantized if any of its inputs is produced by a DequantizeLinear node
+    quantized_graph_nodes = [
+        node
+        for node in graph.nodes
+        if any(tensor.name in dq_output_names for tensor in node.inputs)
+    ]
+    quantized_nodes = [node.name for node in quantized_graph_nodes]
+    quantized_type_counts = dict(Counter(node.op for node in quantized_graph_nodes))
+    count = len(quantized_nodes)
 
     if verbose:
         logging.info(f"Quantized nodes: {quantized_nodes}")
@@ -792,31 +976,66 @@ def print_stat(graph: Graph, verbose: bool) -> None:
     logging.info(f"Quantized type counts: {quantized_type_counts}")
 
 
+def _match_chain_type(
+    node: Node, chain_type: List[str], is_forward: bool, wild_card_types: FrozenSet[str]
+) -> Optional[List[Node]]:
+    """Returns the nodes matching chain_type from the given node, None if there is no match.
+
+    This is an iterative form of :func:`has_path_type` for chains without optional types, the
+    wild card types are matched by op type only. Each (node, chain position) state is expanded at
+    most once, so the walk is linear in the visited edges.
+    """
+    stack = [(node, 0, ())]
+    visited = set()
+    while stack:
+        cur_node, state, matched_nodes = stack.pop()
+        if (id(cur_node), state) in visited:
+            continue
+        visited.add((id(cur_node), state))
+
+        if cur_node.op == chain_type[state]:
+            matched_nodes = (*matched_nodes, cur_node)
+            state += 1
+            if state == len(chain_type):
+                return list(matched_nodes)
+        elif cur_node.op not in wild_card_types:
+            continue
+
+        next_level_nodes = get_child_nodes(cur_node) if is_forward else get_parent_nodes(cur_node)
+        # Push in reverse so that the next level nodes are tried in order
+        stack.extend((next_node, state, matched_nodes) for next_node in reversed(next_level_nodes))
+
+    return None
+
+
 def find_mha_partitions(graph):
-    """Match MHA: BMM1 -> (Mul/Div) -> (Add) -> Softmax -> (Cast) -> BMM2."""
+    """Match MHA: BMM1 -> (Mul/Div) -> (Add) -> Softmax -> (Cast) -> BMM2.
+
+    Each returned partition is the list [BMM1, Softmax, BMM2].
+    """
     mha_chain_type = ["MatMul", "Softmax", "MatMul"]
-    wild_card_types = [
-        "Div",
-        "Mul",
-        "ConstMul",
-        "Add",
-        "BiasAdd",
-        "Reshape",
-        "Transpose",
-        "Flatten",
-        "Cast",
-    ]
+
+    # Only MatMuls reaching a Softmax through wild card nodes can start the chain
+    bmm1_candidates = set()
+    stack = [node for node in graph.nodes if node.op == "Softmax"]
+    visited = set()
+    while stack:
+        node = stack.pop()
+        for parent in get_parent_nodes(node):
+            if id(parent) in visited:
+                continue
+            visited.add(id(parent))
+            if parent.op == "MatMul":
+                bmm1_candidates.add(id(parent))
+            elif parent.op in _MHA_WILD_CARD_TYPES:
+                stack.append(parent)
+
     mha_partitions = []
     for node in graph.nodes:
-        if node.op == "MatMul":
-            mha_partition = []
-            if has_path_type(node, graph, mha_chain_type, True, wild_card_types, mha_partition):
-                if (
-                    len(mha_partition) == 3
-                    and mha_partition[0].op == "MatMul"
-                    and mha_partition[2].op == "MatMul"
-                ):
-                    mha_partitions.append(mha_partition)
+        if id(node) in bmm1_candidates:
+            mha_partition = _match_chain_type(node, mha_chain_type, True, _MHA_WILD_CARD_TYPES)
+            if mha_partition:
+                mha_partitions.append(mha_partition)
 
     return mha_partitions
 
@@ -832,76 +1051,73 @@ def find_fp8_mha_partitions(graph):
         "QuantizeLinear",
         "DequantizeLinear",
     ]
-    wild_card_types = [
-        "Div",
-        "Mul",
-        "ConstMul",
-        "Add",
-        "BiasAdd",
-        "Reshape",
-        "Transpose",
-        "Flatten",
-        "Cast",
-    ]
     fp8_mha_partitions = []
     for node in graph.nodes:
         if node.op == "Softmax":
-            fp8_mha_partition = []
-            if has_path_type(
-                node, graph, softmax_bmm1_chain_type, False, wild_card_types, fp8_mha_partition
-            ) and has_path_type(
-                node, graph, softmax_bmm2_chain_type, True, wild_card_types, fp8_mha_partition
-            ):
-                if (
-                    len(fp8_mha_partition) == 10
-                    and fp8_mha_partition[1].op == "MatMul"
-                    and fp8_mha_partition[7].op == "MatMul"
-                ):
-                    fp8_mha_partitions.append(fp8_mha_partition)
+            bmm1_partition = _match_chain_type(
+                node, softmax_bmm1_chain_type, False, _MHA_WILD_CARD_TYPES
+            )
+            if not bmm1_partition:
+                continue
+
+            bmm2_partition = _match_chain_type(
+                node, softmax_bmm2_chain_type, True, _MHA_WILD_CARD_TYPES
+            )
+            if bmm2_partition:
+                # [Softmax, BMM1, DQ, Q, Softmax, Q, DQ, BMM2, Q, DQ]
+                fp8_mha_partitions.append(bmm1_partition + bmm2_partition)
 
     return fp8_mha_partitions
 
 
-def insert_matmul_casts(graph, matmul_node):
-    """Insert three cast nodes for MatMul's two inputs and output."""
-    matmul_input0 = matmul_node.inputs[0]
-    matmul_input0_cast_output = gs.Variable(
-        name=f"{matmul_input0.name}/Cast_output", dtype=np.float32
-    )
-    graph.layer(
-        op="Cast",
-        name=f"{matmul_input0.name}/Cast",
-        inputs=[matmul_input0],
-        outputs=[matmul_input0_cast_output],
-        attrs={"to": np.float32},
-    )
-    matmul_node.inputs[0] = matmul_input0_cast_output
+def insert_matmul_casts(graph, matmul_node, cast_outputs=None):
+    """Insert three cast nodes for MatMul's two inputs and output.
 
-    matmul_input1 = matmul_node.inputs[1]
-    matmul_input1_cast_output = gs.Variable(
-        name=f"{matmul_input1.name}/Cast_output", dtype=np.float32
-    )
-    graph.layer(
-        op="Cast",
-        name=f"{matmul_input1.name}/Cast",
-        inputs=[matmul_input1],
-        outputs=[matmul_input1_cast_output],
-        attrs={"to": np.float32},
-    )
-    matmul_node.inputs[1] = matmul_input1_cast_output
+    cast_outputs optionally maps input tensor names to their already inserted FP32 Cast outputs.
+    An input found there reuses that Cast, new input Casts are added to it.
+    """
+    if cast_outputs is None:
+        cast_outputs = {}
+
+    cast_nodes = []
+    for input_idx in range(2):
+        matmul_input = matmul_node.inputs[input_idx]
+        if matmul_input.name in cast_outputs:
+            matmul_node.inputs[input_idx] = cast_outputs[matmul_input.name]
+            continue
+
+        matmul_input_cast_output = gs.Variable(
+            name=f"{matmul_input.name}/Cast_output", dtype=np.float32
+        )
+        cast_nodes.append(
+            gs.Node(
+                op="Cast",
+                name=f"{matmul_input.name}/Cast",
+                inputs=[matmul_input],
+                outputs=[matmul_input_cast_output],
+                attrs={"to": int(onnx.TensorProto.FLOAT)},
+            )
+        )
+        matmul_node.inputs[input_idx] = matmul_input_cast_output
+        cast_outputs[matmul_input.name] = matmul_input_cast_output
 
     matmul_output = matmul_node.outputs[0]
     matmul_output_cast_input = gs.Variable(
         name=f"{matmul_output.name}/Cast_output", dtype=np.float16
     )
-    graph.layer(
-        op="Cast",
-        name=f"{matmul_output.name}/Cast",
-        inputs=[matmul_output_cast_input],
-        outputs=[matmul_output],
-        attrs={"to": np.float16},
-    )
+    # Detach the output from MatMul before it is attached as the output of the Cast node
     matmul_node.outputs[0] = matmul_output_cast_input
+    cast_nodes.append(
+        gs.Node(
+            op="Cast",
+            name=f"{matmul_output.name}/Cast",
+            inputs=[matmul_output_cast_input],
+            outputs=[matmul_output],
+            attrs={"to": int(onnx.TensorProto.FLOAT16)},
+        )
+    )
+
+    graph.nodes.extend(cast_nodes)
 
 
 def insert_fp8_mha_casts(onnx_model):
@@ -914,15 +1130,19 @@ def insert_fp8_mha_casts(onnx_model):
     with FP16 accumulation because the compiler only has FP32 accumulation kernels for FP8 MHAs.
     """
     graph = gs.import_onnx(onnx_model)
-    graph.cleanup().toposort()
 
     # Match FP8 MHA: Q -> DQ -> BMM1 -> (Mul/Div) -> (Add) -> Softmax -> (Cast) -> Q -> DQ -> BMM2 -> Q -> DQ
     fp8_mha_partitions = find_fp8_mha_partitions(graph)
+    if not fp8_mha_partitions:
+        # Nothing to insert, skip exporting the graph back to a model
+        return onnx_model
 
     # Insert cast nodes on BMM1 and BMM2's input and output tensors.
+    # Inputs shared by several MatMuls are cast once and the Cast output is reused.
+    cast_outputs = {}
     for fp8_mha_partition in fp8_mha_partitions:
-        insert_matmul_casts(graph, fp8_mha_partition[1])
-        insert_matmul_casts(graph, fp8_mha_partition[7])
+        insert_matmul_casts(graph, fp8_mha_partition[1], cast_outputs)
+        insert_matmul_casts(graph, fp8_mha_partition[7], cast_outputs)
 
     graph.cleanup().toposort()
 
@@ -10,21 +10,24 @@
 
 """Performs INT4 WoQ on an ONNX model, and returns the ONNX ModelProto."""
 
-import copy
 import gc
 import logging
 import math
 import os
 import platform
+import shutil
 import tempfile
 import time
 import warnings
-from typing import List, Tuple, cast
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, List, Optional, Tuple, cast
 
 import numpy
 import onnx
 import onnx.numpy_helper as numpy_helper
 import onnx_graphsurgeon as gs
+import onnxruntime as ort
+from onnx.external_data_helper import load_external_data_for_model
 from onnxruntime.quantization.calibrate import CalibrationDataReader
 from tqdm import tqdm
 
@@ -75,20 +78,22 @@ INT4_MAX = 2 ** (NUM_BITS - 1) - 1  # 7
 
 EXCLUDE_NODES = ["lm_head"]
 
+# Max. concurrent AWQ clip searches; each holds its layer's activations and search intermediates
+MAX_CLIP_SEARCH_WORKERS = 2
+
 
 def _next_block_size_multiple(x: float, block_size: int) -> float:
     return math.ceil(x / block_size) * block_size
 
 
-def _pad(w: np.ndarray, block_size: int) -> np.ndarray:
-    """Pads `w` to next largest multiple of block_size, on axis 0."""
-    if w.shape[0] % block_size == 0:
+def _pad(w: np.ndarray, block_size: int, axis: int = 0) -> np.ndarray:
+    """Pads `w` to next largest multiple of block_size, on `axis` (0 by default)."""
+    if w.shape[axis] % block_size == 0:
         return w
 
-    pad_width = _next_block_size_multiple(w.shape[0], block_size) - w.shape[0]
-    pads = [(0, 0) for _ in range(len(w.shape))]
-    pads[0] = (0, pad_width)
-    return np.pad(w, pads, mode="constant", constant_values=0)
+    pad_shape = list(w.shape)
+    pad_shape[axis] = _next_block_size_multiple(w.shape[axis], block_size) - w.shape[axis]
+    return np.concatenate([w, np.zeros(pad_shape, dtype=w.dtype)], axis=axis)
 
 
 def _depad(w: np.ndarray, orig_shape: tuple) -> np.ndarray:
@@ -98,16 +103,30 @@ def _depad(w: np.ndarray, orig_shape: tuple) -> np.ndarray:
     return w[0 : orig_shape[0], ...]
 
 
+def _to_blocked(w: np.ndarray, block_size: int) -> np.ndarray:
+    """Pads axis 0 of `w` and returns its (co, n_block, block_size) blocked layout."""
+    w = _pad(w, block_size).T
+    return w.reshape(*w.shape[:-1], -1, block_size)
+
+
+def _from_blocked(w_blocks: np.ndarray, orig_shape: tuple) -> np.ndarray:
+    """Inverse of `_to_blocked`, also removing the padding of axis 0."""
+    w = w_blocks.reshape(*w_blocks.shape[:-2], -1).T
+    return _depad(w, orig_shape)
+
+
+def _block_amax(w_blocks: np.ndarray, keepdims: bool = False) -> np.ndarray:
+    """Returns the abs max over the last axis without materializing `abs(w_blocks)`."""
+    return np.maximum(
+        w_blocks.max(axis=-1, keepdims=keepdims), -w_blocks.min(axis=-1, keepdims=keepdims)
+    )
+
+
 def find_scales(w: np.ndarray, block_size: int, alpha: float = 1.0) -> np.ndarray:
     """Find scale factors for `w` via `s = max(w.block(block_size)) / 7`."""
-    w = _pad(w, block_size)
-    w = w.T
-    w_amax = np.abs(w.reshape(-1, block_size)).max(axis=-1)
+    w_amax = _block_amax(_to_blocked(w, block_size))
     s = (w_amax * alpha) / INT4_SCALE
-    s_last_dim = w.shape[-1] // block_size
-    s_shape = list(w.shape)
-    s_shape[-1] = s_last_dim
-    return s.reshape(s_shape).T
+    return s.T
 
 
 def rtn(w: np.ndarray, s: np.ndarray, block_size: int) -> np.ndarray:
@@ -116,19 +135,18 @@ def rtn(w: np.ndarray, s: np.ndarray, block_size: int) -> np.ndarray:
     Ties are broken by rounding to the nearest even number.
     """
     w_padded = _pad(w, block_size)
-    num_blocks = w_padded.shape[0] // s.shape[0]
-    w_padded = (
-        np.rint(w_padded / s.repeat(num_blocks, axis=0)).clip(INT4_MIN, INT4_MAX).astype(np.int8)
-    )
-    return _depad(w_padded, w.shape)
+    # View the weight as (n_block, block_size, ...) so `s` broadcasts instead of being repeated
+    w_blocks = w_padded.reshape(s.shape[0], -1, *w_padded.shape[1:])
+    wq = np.rint(w_blocks / s[:, np.newaxis]).clip(INT4_MIN, INT4_MAX).astype(np.int8)
+    return _depad(wq.reshape(w_padded.shape), w.shape)
 
 
 def dq_tensor(w: np.ndarray, s: np.ndarray, block_size: int) -> np.ndarray:
     """Dequantizes `w` with scale factors `s`."""
     w_padded = _pad(w, block_size)
-    num_blocks = w_padded.shape[0] // s.shape[0]
-    w_padded = w_padded * s.repeat(num_blocks, axis=0)
-    return _depad(w_padded, w.shape)
+    w_blocks = w_padded.reshape(s.shape[0], -1, *w_padded.shape[1:])
+    dqw = w_blocks * s[:, np.newaxis]
+    return _depad(dqw.reshape(w_padded.shape), w.shape)
 
 
 def quantize_rtn(
@@ -164,16 +182,16 @@ def quantize_rtn(
     logging.info("Computed scales.")
 
     # Change the scale type to the expected type, fp16 by default
+    io_dtype = onnx.mapping.TENSOR_TYPE_MAP[gemm_io_type].np_dtype
     for name, _ in scales.items():
         s = scales[name]
-        scales[name] = s.astype(onnx.mapping.TENSOR_TYPE_MAP[gemm_io_type].np_dtype)
+        scales[name] = s.astype(io_dtype)
 
-    # Change the input activation type to the expected type, fp16 by default
+    # Change the input activation type to the expected type, fp16 by default. Like
+    # `_change_input_type`, only tensors that already carry type info are updated
     for act_tensor in act_tensors:
-        _change_input_type(onnx_model.graph, act_tensor.name, gemm_io_type)
-
-    # Import the update graph
-    graph = gs.import_onnx(onnx_model)
+        if isinstance(act_tensor, gs.Variable) and act_tensor.dtype is not None:
+            act_tensor.dtype = io_dtype
 
     if dq_only:
         # Calculate actual quantized weights.
@@ -197,10 +215,16 @@ def quantize_rtn(
 
 
 def quant_tensor(w: np.ndarray, block_size: int, alpha: float = 1.0):
-    """Quantize a tensor using alpha etc. and return the quantized tensor."""
-    scale = find_scales(w, block_size, alpha)
-    wq = rtn(w, scale, block_size)
-    return wq, scale
+    """Quantize a tensor using alpha etc. and return the quantized tensor.
+
+    Equivalent to `find_scales` followed by `rtn`, but pads and blocks the weight only once.
+    `alpha` is either a scalar or has the (co, n_block) shape of the block scales.
+    """
+    w_blocks = _to_blocked(w, block_size)
+    w_amax = _block_amax(w_blocks)
+    s = (w_amax * alpha) / INT4_SCALE
+    wq = np.rint(w_blocks / s[..., np.newaxis]).clip(INT4_MIN, INT4_MAX).astype(np.int8)
+    return _from_blocked(wq, w.shape), s.T
 
 
 class AWQClipHelper:
@@ -214,8 +238,7 @@ class AWQClipHelper:
         """Initializes AWQClipHelper with a module weight."""
         ci, co = w.shape
         self.block_size = block_size if block_size != -1 else w.shape[0]
-        w = _pad(w, block_size).T
-        self.w_amax = np.abs(w.reshape(-1, block_size)).max(axis=-1)
+        self.w_amax = _block_amax(_to_blocked(w, self.block_size))  # co, n_block
 
         self.loss = {
             k: np.zeros((co, math.ceil(ci / self.block_size)), dtype=np.float32)
@@ -226,11 +249,11 @@ class AWQClipHelper:
 
     def update_best_params(self):
         """Updates the loss dictionary."""
-        for alpha, loss in self.loss.items():
-            loss = loss.reshape(self.w_amax.shape)
-            indices = loss < self.best_loss
-            self.best_loss = np.where(indices, loss, self.best_loss)
-            self.best_alpha = np.where(indices, alpha, self.best_alpha)
+        losses = np.stack(list(self.loss.values()))  # n_alpha, co, n_block
+        # argmin keeps the first (smallest) alpha on ties, like the strict per-alpha comparison did
+        best_idx = losses.argmin(axis=0)
+        self.best_loss = losses.min(axis=0)
+        self.best_alpha = np.asarray(list(self.loss.keys()), dtype=self.best_alpha.dtype)[best_idx]
 
 
 def _clip_search(
@@ -255,48 +278,52 @@ def _clip_search(
     ci, co = w.shape
     block_size = awq_clip.block_size
 
-    # Pad weight and input if necessary
+    # Pad input if necessary, the weight is padded when blocked
     if ci % block_size != 0:
-        w = _pad(w, block_size)
-        x = _pad(x.T, block_size).T
-
-    # Make a copy of the original padded weight to quantize with generated scales
-    w_copy = copy.deepcopy(w)
+        x = _pad(x, block_size, axis=1)
 
     # Reshape weight and input for batch processing over co dimension
-    w = w.T  # co, ci
-    w = w.reshape(co, 1, -1, block_size)  # co, 1, n_block, block_size
-    x = x.reshape(1, x.shape[0], -1, block_size)  # 1, max_tokens, n_block, block_size
+    w = _to_blocked(w, block_size)  # co, n_block, block_size
+    x = x.reshape(x.shape[0], -1, block_size)  # max_tokens, n_block, block_size
+
+    # Stack the alpha values to quantize the weight for all of them at once
+    alphas = list(awq_clip.loss.keys())
+    alphas_arr = np.asarray(alphas, dtype=w.dtype).reshape(-1, 1, 1, 1)  # n_alpha, 1, 1, 1
 
     # Loop over co dimension of the weight and generate scales
     for co_batch in range(math.ceil(co / co_bsz)):
         slice_s, slice_e = co_batch * co_bsz, min((co_batch + 1) * co_bsz, co)
-        weight = w[slice_s:slice_e]
-        org_out = np.sum(x * weight, axis=-1)  # co_bsz, max_tokens, n_block
+        weight = w[slice_s:slice_e]  # co_bsz, n_block, block_size
+        org_out = np.einsum("tnk,cnk->ctn", x, weight)  # co_bsz, max_tokens, n_block
+
+        # Perform QDQ on the weight batch for every alpha value, blocks are quantized independently
+        w_amax = _block_amax(weight, keepdims=True)  # co_bsz, n_block, 1
+        scales = (w_amax * alphas_arr) / INT4_SCALE  # n_alpha, co_bsz, n_block, 1
+        qw = np.rint(weight / scales).clip(INT4_MIN, INT4_MAX).astype(np.int8)
+        cur_w = qw * scales  # n_alpha, co_bsz, n_block, block_size
 
         # Compute loss for each alpha value
-        for alpha in awq_clip.loss.keys():
-            # Perform QDQ on the whole original weight tensor
-            qw, scales = quant_tensor(w_copy, block_size, alpha)
-            cur_w = dq_tensor(qw, scales, block_size)
-
-            # Reshape before getting the batch of size co_bsz to multiply with input
-            cur_w = cur_w.T  # ci, co -> co, ci
-            cur_w = cur_w.reshape(co, 1, -1, block_size)  # co, 1, n_block, block_size
-            cur_w = cur_w[slice_s:slice_e]
-
-            # Compute loss for each batch
-            cur_out = np.sum(x * cur_w, axis=-1)  # co_bsz, max_tokens, n_block
-            loss = np.mean(np.power((org_out - cur_out), 2), axis=1)  # co_bsz, n_block
+        cur_out = np.einsum("tnk,acnk->actn", x, cur_w)  # n_alpha, co_bsz, max_tokens, n_block
+        loss = np.mean(np.power((org_out - cur_out), 2), axis=2)  # n_alpha, co_bsz, n_block
+        for alpha_idx, alpha in enumerate(alphas):
             if has_jax:
-                awq_clip.loss[alpha] += awq_clip.loss[alpha].at[slice_s:slice_e].set(loss)
+                awq_clip.loss[alpha] = (
+                    awq_clip.loss[alpha].at[slice_s:slice_e].add(loss[alpha_idx])
+                )
             else:
-                awq_clip.loss[alpha][slice_s:slice_e] += loss
+                awq_clip.loss[alpha][slice_s:slice_e] += loss[alpha_idx]
 
     # Update the best alpha value for the weight blocks
     awq_clip.update_best_params()
 
 
+def _find_clip_alpha(x: np.ndarray, w: np.ndarray) -> np.ndarray:
+    """Runs the AWQ clip search on one weight and returns its best per-block alpha."""
+    awq_clip = AWQClipHelper(w, BLOCK_SIZE)
+    _clip_search(x, w, awq_clip)
+    return awq_clip.best_alpha
+
+
 def _find_quantizable_weights(
     graph: onnx.onnx_pb.GraphProto,
 ) -> List[Tuple[onnx.onnx_pb.ValueInfoProto, onnx.onnx_pb.ValueInfoProto, bool, int]]:
@@ -355,23 +382,111 @@ def _augment_graph(
             augmented_outputs.add(act_tensor.name)
 
 
+def _load_weights(
+    wa_pack: List[Tuple[onnx.onnx_pb.ValueInfoProto, onnx.onnx_pb.TensorProto, bool, int]],
+) -> Dict[str, numpy.ndarray]:
+    """Decodes each quantizable weight once, transposed to (ci, co) for Gemm with transB."""
+    weights = {}
+    for _, weight_tensor, do_transpose, _ in wa_pack:
+        if weight_tensor.name not in weights:
+            w = numpy_helper.to_array(weight_tensor)
+            weights[weight_tensor.name] = w.T if do_transpose else w
+    return weights
+
+
+def _create_augmented_model_path() -> str:
+    """Creates the temporary file `_create_augmented_session` may save the augmented model to."""
+    augmented_onnx_file, augmented_onnx_path = tempfile.mkstemp(suffix=".onnx")
+    os.close(augmented_onnx_file)
+    return augmented_onnx_path
+
+
+def _create_augmented_session(
+    onnx_model: onnx.onnx_pb.ModelProto, augmented_onnx_path: str, use_external_data_format: bool
+) -> ort.InferenceSession:
+    """Creates an ORT session for the augmented model.
+
+    The session is created from the serialized model when it fits in a single protobuf. Otherwise
+    the model is saved to `augmented_onnx_path`, which moves its weights to external data in place.
+    """
+    if not use_external_data_format:
+        try:
+            return create_inference_session(onnx_model.SerializeToString())
+        except ValueError:
+            # Models larger than 2GB cannot be serialized without external data
+            pass
+
+    save_onnx(onnx_model, augmented_onnx_path, use_external_data_format)
+    return create_inference_session(augmented_onnx_path)
+
+
+def _restore_augmented_model(
+    onnx_model: onnx.onnx_pb.ModelProto,
+    num_outputs: int,
+    ir_version: int,
+    augmented_onnx_path: str,
+):
+    """Drops the outputs added by `_augment_graph` and reloads weights moved out by `save_onnx`."""
+    del onnx_model.graph.output[num_outputs:]
+    onnx_model.ir_version = ir_version
+    # A no-op if the model was never saved to `augmented_onnx_path`
+    load_external_data_for_model(onnx_model, os.path.dirname(augmented_onnx_path))
+
+
+def _remove_augmented_model_files(augmented_onnx_path: str):
+    """Removes the temporary model and external data written by `_create_augmented_session`."""
+    try:
+        os.remove(augmented_onnx_path)
+        if os.path.exists(augmented_onnx_path + "_data"):
+            os.remove(augmented_onnx_path + "_data")
+    except OSError:
+        logging.warn("Augmented ONNX model or external data file was not found!")
+
+
+def _get_type_infos(graph: onnx.onnx_pb.GraphProto) -> Dict[str, onnx.onnx_pb.ValueInfoProto]:
+    """Maps tensor names to their value info, falling back to the graph inputs."""
+    type_infos = {}
+    for value_info in list(graph.value_info) + list(graph.input):
+        type_infos.setdefault(value_info.name, value_info)
+    return type_infos
+
+
 def _change_input_type(
-    graph: onnx.onnx_pb.GraphProto, input_name: str, gemm_io_type: onnx.TensorProto.DataType
+    type_infos: Dict[str, onnx.onnx_pb.ValueInfoProto],
+    input_name: str,
+    gemm_io_type: onnx.TensorProto.DataType,
 ):
-    # Find the corresponding value info in the graph
-    done = False
-    for value_info in graph.value_info:
-        if value_info.name == input_name:
-            value_info.type.tensor_type.elem_type = gemm_io_type
-            done = True
-            break
-
-    if not done:
-        # If input not in value_info, it must be a graph input
-        for input_info in graph.input:
-            if input_info.name == input_name:
-                input_info.type.tensor_type.elem_type = gemm_io_type
-                break
+    # Find the corresponding value info, or graph input, in the index from `_get_type_infos`
+    if input_name in type_infos:
+        type_infos[input_name].type.tensor_type.elem_type = gemm_io_type
+
+
+def _cache_activations(
+    session,
+    inputs: List[Dict[str, numpy.ndarray]],
+    tensor_names: List[str],
+    cache_dir: Optional[str] = None,
+) -> List[List[numpy.ndarray]]:
+    """Runs each calibration input once and returns its `tensor_names` outputs.
+
+    If `cache_dir` is given, the outputs are written to memory-mapped files in it instead of RAM.
+    """
+    output_data = []
+    for j in tqdm(range(len(inputs)), desc="Caching activations..."):
+        output = session.run(tensor_names, inputs[j])
+        if cache_dir is not None:
+            for i, out in enumerate(output):
+                out_file = numpy.memmap(
+                    os.path.join(cache_dir, f"{j}_{i}.bin"),
+                    dtype=out.dtype,
+                    mode="w+",
+                    shape=out.shape,
+                )
+                out_file[:] = out
+                out_file.flush()
+                output[i] = out_file
+        output_data.append(output)
+    return output_data
 
 
 def quantize_awq_clip(
@@ -379,75 +494,107 @@ def quantize_awq_clip(
     data_reader: CalibrationDataReader,
     use_external_data_format: bool,
     force_fp16: bool = False,
+    enable_fast_path_using_disk_cache: bool = False,
 ) -> onnx.onnx_pb.ModelProto:
-    """Quantizes `onnx_model` using the Activation aware quantization a.k.a AWQ algorithm."""
+    """Quantizes `onnx_model` using the Activation aware quantization a.k.a AWQ algorithm.
+
+    On the numpy path, the clip searches of up to `MAX_CLIP_SEARCH_WORKERS` layers run concurrently
+    with the activation capture of the next layer. Each in-flight search holds its layer's
+    concatenated activations (n_token x ci, fp32) and the batched search intermediates, so peak host
+    memory grows with the number of workers; set it to 1 to keep a single layer live at a time.
+    """
     logging.info("Finding quantizable weights and augmenting graph output with input activations")
     t = time.time()
-    augmented_model = copy.deepcopy(onnx_model)
-    graph = augmented_model.graph
+    graph = onnx_model.graph
 
-    # Collect quantizable weight tensors
+    # Collect quantizable weight tensors and decode them before the graph is saved
     wa_pack = _find_quantizable_weights(graph)
+    weights = _load_weights(wa_pack)
 
-    # Add input activations to graph output
-    _augment_graph(augmented_model.graph, wa_pack)
-    logging.info(f"Augmenting took {time.time() - t} seconds")
-
-    scales = {}
-    gemm_weights_quantized = {}
-
-    t = time.time()
-
-    # Create a temp file for augmented model
-    augmented_onnx_file, augmented_onnx_path = tempfile.mkstemp(suffix=".onnx")
-    os.close(augmented_onnx_file)
-
-    # TODO: ONNX version issue, onnx_export uses current ONNX IR version.
-    augmented_model.ir_version = 9
-    save_onnx(augmented_model, augmented_onnx_path, use_external_data_format)
-    logging.info(f"Saving the model took {time.time() - t} seconds")
-
-    # Creating inference session and preparing inputs for calibration
-    session = create_inference_session(augmented_onnx_path)
-    inputs = []
-    for inp_d in data_reader:
-        inputs.append(inp_d)
-        assert isinstance(inp_d, dict)
-
-    # Apply AWQ clip on selected weights
-    t = time.time()
-    alphas = {}
-    for i in tqdm(range(len(wa_pack)), desc="Running clip search..."):
+    # Add input activations to graph output. The caller's model is restored (and the temporary
+    # files removed) once calibration is done, also if it fails
+    num_outputs, ir_version = len(graph.output), onnx_model.ir_version
+    augmented_onnx_path = _create_augmented_model_path()
+    cache_dir = None
+    try:
+        _augment_graph(graph, wa_pack)
+        logging.info(f"Augmenting took {time.time() - t} seconds")
 
-        act_tensor, weight_tensor, do_transpose, gemm_io_type = wa_pack[i]
+        t = time.time()
 
-        # First capture all the  activation values after calibration data sweep
-        output_dicts = {}
-        for inp_d in inputs:
-            np_inp_d = {name: numpy.asarray(tensor) for name, tensor in inp_d.items()}
-            output = session.run([act_tensor.name], np_inp_d)
-            out = np.asarray(output[0])
-            output_dicts.setdefault(act_tensor.name, []).append(out)
-
-        # Concatenating the activation tensors over all calib data
-        x = np.concatenate(output_dicts[act_tensor.name], axis=0)  # n_token, ci
-        w = numpy_helper.to_array(
-            weight_tensor, base_dir=os.path.dirname(augmented_onnx_path)
-        ).copy()
-        if do_transpose:
-            w = w.T
-        w = np.asarray(w)
+        # TODO: ONNX version issue, onnx_export uses current ONNX IR version.
+        onnx_model.ir_version = 9
 
-        awq_clip = AWQClipHelper(w, BLOCK_SIZE)
-        _clip_search(x, w, awq_clip)
-        alphas[weight_tensor.name] = awq_clip.best_alpha
+        # Creating inference session and preparing inputs for calibration
+        session = _create_augmented_session(
+            onnx_model, augmented_onnx_path, use_external_data_format
+        )
+        logging.info(f"Creating the inference session took {time.time() - t} seconds")
+        inputs = []
+        for inp_d in data_reader:
+            assert isinstance(inp_d, dict)
+            inputs.append({name: numpy.asarray(tensor) for name, tensor in inp_d.items()})
+
+        # Run the calibration data once and keep the activations on disk if enabled
+        output_data = []
+        if enable_fast_path_using_disk_cache:
+            cache_dir = tempfile.mkdtemp()
+            tensor_names_list = [act_tensor.name for act_tensor, _, _, _ in wa_pack]
+            output_data = _cache_activations(session, inputs, tensor_names_list, cache_dir)
+
+        # Apply AWQ clip on selected weights. numpy releases the GIL in the search math, so on that
+        # path the searches run on a thread pool while the next activations are captured
+        t = time.time()
+        num_workers = (
+            1 if has_jax or has_cupy else min(os.cpu_count() or 1, MAX_CLIP_SEARCH_WORKERS)
+        )
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            pending = set()
+            alpha_futures = {}
+            for i in tqdm(range(len(wa_pack)), desc="Running clip search..."):
+
+                act_tensor, weight_tensor, do_transpose, gemm_io_type = wa_pack[i]
+
+                # First capture all the  activation values after calibration data sweep
+                acts = []
+                if output_data:
+                    for j in range(len(output_data)):
+                        acts.append(output_data[j][i])
+                        output_data[j][i] = None
+                else:
+                    for np_inp_d in inputs:
+                        acts.append(session.run([act_tensor.name], np_inp_d)[0])
+
+                # Concatenating the activation tensors over all calib data on host, then copying
+                # once
+                x = np.asarray(numpy.concatenate(acts, axis=0))  # n_token, ci
+                del acts
+                w = np.asarray(weights[weight_tensor.name])
+
+                # Bound the number of in-flight searches to limit the activations held in memory
+                if len(pending) >= num_workers:
+                    _, pending = wait(pending, return_when=FIRST_COMPLETED)
+                future = executor.submit(_find_clip_alpha, x, w)
+                pending.add(future)
+                alpha_futures[weight_tensor.name] = future
+
+        alphas = {name: future.result() for name, future in alpha_futures.items()}
+        logging.info(f"Clip search for all weights took {time.time() - t} seconds")
 
-    logging.info(f"Clip search for all weights took {time.time() - t} seconds")
+        del session
+    finally:
+        if cache_dir is not None:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        _restore_augmented_model(onnx_model, num_outputs, ir_version, augmented_onnx_path)
+        _remove_augmented_model_files(augmented_onnx_path)
 
-    del session
+    scales = {}
+    gemm_weights_quantized = {}
 
     # Compute quantized weights and scales which are needed for DQ nodes
     t = time.time()
+    type_infos = _get_type_infos(onnx_model.graph)
+    io_dtypes = {}
     for i in tqdm(range(len(wa_pack)), desc="Quantizing the weights..."):
 
         act_tensor, weight_tensor, do_transpose, gemm_io_type = wa_pack[i]
@@ -455,13 +602,11 @@ def quantize_awq_clip(
 
         if force_fp16:
             gemm_io_type = onnx.TensorProto.FLOAT16
+        if gemm_io_type not in io_dtypes:
+            io_dtypes[gemm_io_type] = onnx.mapping.TENSOR_TYPE_MAP[gemm_io_type].np_dtype
+        io_dtype = io_dtypes[gemm_io_type]
 
-        w = numpy_helper.to_array(
-            weight_tensor, base_dir=os.path.dirname(augmented_onnx_path)
-        ).copy()
-        if do_transpose:
-            w = w.T
-        w = np.asarray(w)
+        w = np.asarray(weights[weight_tensor.name])
 
         alpha = alphas.get(weight_tensor.name, 1)
         qw, scale = quant_tensor(w, BLOCK_SIZE, alpha)
@@ -471,14 +616,12 @@ def quantize_awq_clip(
         if do_transpose:
             qw = qw.T
             scale = scale.T
-        scales[weight_tensor.name] = scale.astype(
-            onnx.mapping.TENSOR_TYPE_MAP[gemm_io_type].np_dtype
-        )
+        scales[weight_tensor.name] = scale.astype(io_dtype)
         gemm_weights_quantized[weight_tensor.name] = numpy.asarray(qw).astype(numpy.int8)
 
         # Change the input activation type to the expected type, fp16 by default
         # TODO: cast input C for Gemm
-        _change_input_type(onnx_model.graph, act_tensor.name, gemm_io_type)
+        _change_input_type(type_infos, act_tensor.name, gemm_io_type)
 
     logging.info(f"Quantizing actual weights took {time.time() - t} seconds")
 
@@ -497,13 +640,6 @@ def quantize_awq_clip(
     model.ir_version = 9
     logging.info(f"Exporting took {time.time() - t} seconds")
 
-    try:
-        os.remove(augmented_onnx_path)
-        if use_external_data_format:
-            os.remove(augmented_onnx_path + "_data")
-    except OSError:
-        logging.warn("Augmented ONNX model or external data file was not found!")
-
     return model
 
 
@@ -544,8 +680,10 @@ def get_weight_scale(weight, block_size=None):
             weight = _pad(weight, block_size)
             org_shape = weight.shape
         weight = weight.reshape(block_size, -1)
-    weight_abs_amax = weight.__abs__().max(axis=0, keepdims=True)
-    scale = weight.__abs__() / (weight_abs_amax + np.finfo(weight_abs_amax.dtype).tiny)
+    weight_abs = weight.__abs__()
+    weight_abs_amax = weight_abs.max(axis=0, keepdims=True)
+    scale = weight_abs / (weight_abs_amax + np.finfo(weight_abs_amax.dtype).tiny)
+    del weight_abs
     scale = scale.reshape(org_shape)
     if slice_after_padding is not None:
         scale = scale[slice_after_padding, ...]
@@ -568,6 +706,7 @@ def quantize_awq_lite(
     use_external_data_format: bool,
     force_fp16: bool = False,
     enable_fast_path_using_high_sysram: bool = False,
+    enable_fast_path_using_disk_cache: bool = False,
 ) -> onnx.onnx_pb.ModelProto:
     """Quantizes `onnx_model` using the Activation aware quantization a.k.a AWQ algorithm."""
     logging.info("Finding quantizable weights and augmenting graph output with input activations")
@@ -576,136 +715,139 @@ def quantize_awq_lite(
     global BLOCK_SIZE
     BLOCK_SIZE = 128
 
-    augmented_model = copy.deepcopy(onnx_model)
-    graph = augmented_model.graph
+    graph = onnx_model.graph
 
-    # Collect quantizable weight tensors
+    # Collect quantizable weight tensors and decode them before the graph is saved
     wa_pack = _find_quantizable_weights(graph)
+    weights = _load_weights(wa_pack)
 
-    # Add input activations to graph output
-    _augment_graph(augmented_model.graph, wa_pack)
-    logging.info(f"Augmenting took {time.time() - t} seconds")
-
-    scales = {}
-    gemm_weights_quantized = {}
-    input_tensors = {}
-    pre_quant_scale = {}
-
-    t = time.time()
-
-    # Create a temp file for augmented model
-    augmented_onnx_file, augmented_onnx_path = tempfile.mkstemp(suffix=".onnx")
-    os.close(augmented_onnx_file)
-
-    # TODO: ONNX version issue, onnx_export uses current ONNX IR version.
-    augmented_model.ir_version = 9
-    save_onnx(augmented_model, augmented_onnx_path, use_external_data_format)
-    logging.info(f"Saving the model took {time.time() - t} seconds")
-
-    # Creating inference session and preparing inputs for calibration
-    session = create_inference_session(augmented_onnx_path)
-    inputs = []
-    for inp_d in data_reader:
-        inputs.append(inp_d)
-        assert isinstance(inp_d, dict)
-
-    gc.collect()
-
-    output_data = []
-
-    if enable_fast_path_using_high_sysram:
+    # Add input activations to graph output. The caller's model is restored (and the temporary
+    # files removed) once calibration is done, also if it fails
+    num_outputs, ir_version = len(graph.output), onnx_model.ir_version
+    augmented_onnx_path = _create_augmented_model_path()
+    cache_dir = None
+    try:
+        _augment_graph(graph, wa_pack)
+        logging.info(f"Augmenting took {time.time() - t} seconds")
 
-        print("Fast-path-using-high-sysram is enabled.\n")
+        t = time.time()
 
-        tensor_names_list = []
-        for i in tqdm(range(len(wa_pack)), desc="Getting tensor names..."):
-            act_tensor, weight_tensor, do_transpose, gemm_io_type = wa_pack[i]
-            tensor_names_list.append(act_tensor.name)
+        # TODO: ONNX version issue, onnx_export uses current ONNX IR version.
+        onnx_model.ir_version = 9
 
-        for i in tqdm(range(len(inputs)), desc="Caching activations..."):
-            inp_d = inputs[i]
-            np_inp_d = {name: numpy.asarray(tensor) for name, tensor in inp_d.items()}
-            output = session.run(tensor_names_list, np_inp_d)
-            output_data.append(output)
+        # Creating inference session and preparing inputs for calibration
+        session = _create_augmented_session(
+            onnx_model, augmented_onnx_path, use_external_data_format
+        )
+        logging.info(f"Creating the inference session took {time.time() - t} seconds")
+        inputs = []
+        for inp_d in data_reader:
+            assert isinstance(inp_d, dict)
+            inputs.append({name: numpy.asarray(tensor) for name, tensor in inp_d.items()})
 
-        del session
-        session = None
         gc.collect()
 
-    # Apply AWQ lite on selected weights
-    t = time.time()
-    awq_lite = []
+        output_data = []
+        use_fast_path = enable_fast_path_using_high_sysram or enable_fast_path_using_disk_cache
 
-    for i in tqdm(
-        range(len(wa_pack)),
-        desc="Running activation-caching and alpha grid search...",
-    ):
+        if use_fast_path:
 
-        act_tensor, weight_tensor, do_transpose, gemm_io_type = wa_pack[i]
+            if enable_fast_path_using_high_sysram:
+                print("Fast-path-using-high-sysram is enabled.\n")
+            else:
+                logging.info("Fast-path-using-disk-cache is enabled.")
+                cache_dir = tempfile.mkdtemp()
 
-        output_dicts = {}
-
-        if enable_fast_path_using_high_sysram:
-            assert (
-                len(output_data) > 0
-            ), "fast-path is enabled but node-inputs are not pre-determined before grid search"
-            node_inputs = []
-            for j in range(len(output_data)):
-                node_inputs.append(np.asarray(output_data[j][i]))
-                # want to free system RAM asap since that data is here copied to GPU for this node
-                output_data[j][i] = None
-            output_dicts[act_tensor.name] = node_inputs
-        else:
-            # First capture all the  activation values after calibration data sweep
-            for inp_d in inputs:
-                np_inp_d = {name: numpy.asarray(tensor) for name, tensor in inp_d.items()}
-                output = session.run([act_tensor.name], np_inp_d)
-                out = np.asarray(output[0])
-                output_dicts.setdefault(act_tensor.name, []).append(out)
-
-        # Concatenating the activation tensors over all calib data
-        w = numpy_helper.to_array(
-            weight_tensor, base_dir=os.path.dirname(augmented_onnx_path)
-        ).copy()
-        if do_transpose:
-            w = w.T
-        w = np.asarray(w)
+            tensor_names_list = [act_tensor.name for act_tensor, _, _, _ in wa_pack]
+            output_data = _cache_activations(session, inputs, tensor_names_list, cache_dir)
 
-        x = np.concatenate(output_dicts[act_tensor.name], axis=0).reshape(
-            (-1, w.shape[0])
-        )  # n_token, ci
+            del session
+            session = None
+            gc.collect()
 
-        awq_lite.append(AWQLiteHelper(x, w, BLOCK_SIZE))
+        # Apply AWQ lite on selected weights
+        t = time.time()
+        awq_lite = []
 
-        out_actual = x.__matmul__(w)
+        for i in tqdm(
+            range(len(wa_pack)),
+            desc="Running activation-caching and alpha grid search...",
+        ):
 
-        for alpha in awq_lite[i].loss.keys():
-            awq_scale = get_scale(
-                awq_lite[i].act_scale,
-                awq_lite[i].weight_scale,
-                alpha,
-                False,  # TODO: look up the purpose of this arg
-            )
-            x_scaled = x * 1.0 / awq_scale
-            w_scaled = w * awq_scale[:, np.newaxis]
+            act_tensor, weight_tensor, do_transpose, gemm_io_type = wa_pack[i]
 
-            qw, scale = quant_tensor(w_scaled, BLOCK_SIZE)
-            dqw = dq_tensor(qw, scale, BLOCK_SIZE)
-            out_curr = x_scaled.__matmul__(dqw)
-            loss = np.mean(np.power((out_actual - out_curr), 2))
-            awq_lite[i].loss[alpha] = loss
+            if use_fast_path:
+                assert (
+                    len(output_data) > 0
+                ), "fast-path is enabled but node-inputs are not pre-determined before grid search"
+                node_inputs = []
+                for j in range(len(output_data)):
+                    node_inputs.append(np.asarray(output_data[j][i]))
+                    # want to free system RAM asap since that data is here copied to GPU
+                    output_data[j][i] = None
+                x = np.concatenate(node_inputs, axis=0)
+                del node_inputs
+            else:
+                # First capture all the  activation values after calibration data sweep, then
+                # concatenate them on host to copy them only once
+                acts = [session.run([act_tensor.name], np_inp_d)[0] for np_inp_d in inputs]
+                x = np.asarray(numpy.concatenate(acts, axis=0))
+                del acts
+
+            w = np.asarray(weights[weight_tensor.name])
+            x = x.reshape((-1, w.shape[0]))  # n_token, ci
+
+            awq_lite.append(AWQLiteHelper(x, w, BLOCK_SIZE))
+
+            # The output error of every alpha is x @ (w - dqw / awq_scale), so its mean square can
+            # be taken against the Gram matrix of x, computed once, instead of one n_token GEMM per
+            # alpha. That only pays off with more tokens than input channels; otherwise the ci x ci
+            # product per alpha is larger than the direct GEMM
+            use_gram = x.shape[0] > x.shape[1]
+            x_f32 = x.astype(np.float32)
+            x_gram = x_f32.T.__matmul__(x_f32) if use_gram else None  # ci, ci
+            n_out = x.shape[0] * w.shape[1]
+
+            for alpha in awq_lite[i].loss.keys():
+                awq_scale = get_scale(
+                    awq_lite[i].act_scale,
+                    awq_lite[i].weight_scale,
+                    alpha,
+                    False,  # TODO: look up the purpose of this arg
+                )
+                w_scaled = w * awq_scale[:, np.newaxis]
+
+                qw, scale = quant_tensor(w_scaled, BLOCK_SIZE)
+                dqw = dq_tensor(qw, scale, BLOCK_SIZE)
+                w_err = (w - dqw / awq_scale[:, np.newaxis]).astype(np.float32)  # ci, co
+                if use_gram:
+                    loss = np.sum(x_gram.__matmul__(w_err) * w_err) / n_out
+                else:
+                    loss = np.sum(np.square(x_f32.__matmul__(w_err))) / n_out
+                awq_lite[i].loss[alpha] = loss
 
-        if has_cupy:
-            np.get_default_memory_pool().free_all_blocks()
+            if has_cupy:
+                np.get_default_memory_pool().free_all_blocks()
 
-    logging.info(
-        f"Caching activation statistics and parameter grid search took {time.time() - t} seconds"
-    )
+        logging.info(
+            "Caching activation statistics and parameter grid search took"
+            f" {time.time() - t} seconds"
+        )
 
-    if session is not None:
-        del session
-        session = None
-        gc.collect()
+        if session is not None:
+            del session
+            session = None
+            gc.collect()
+    finally:
+        if cache_dir is not None:
+            shutil.rmtree(cache_dir, ignore_errors=True)
+        _restore_augmented_model(onnx_model, num_outputs, ir_version, augmented_onnx_path)
+        _remove_augmented_model_files(augmented_onnx_path)
+
+    scales = {}
+    gemm_weights_quantized = {}
+    input_tensors = {}
+    pre_quant_scale = {}
 
     if has_cupy:
         np.get_default_memory_pool().free_all_blocks()
@@ -724,6 +866,8 @@ def quantize_awq_lite(
 
     # Compute quantized weights and scales which are needed for DQ nodes
     t = time.time()
+    type_infos = _get_type_infos(onnx_model.graph)
+    io_dtypes = {}
     for i in tqdm(range(len(wa_pack)), desc="Quantizing the weights..."):
 
         act_tensor, weight_tensor, do_transpose, gemm_io_type = wa_pack[i]
@@ -731,13 +875,11 @@ def quantize_awq_lite(
 
         if force_fp16:
             gemm_io_type = onnx.TensorProto.FLOAT16
+        if gemm_io_type not in io_dtypes:
+            io_dtypes[gemm_io_type] = onnx.mapping.TENSOR_TYPE_MAP[gemm_io_type].np_dtype
+        io_dtype = io_dtypes[gemm_io_type]
 
-        w = numpy_helper.to_array(
-            weight_tensor, base_dir=os.path.dirname(augmented_onnx_path)
-        ).copy()
-        if do_transpose:
-            w = w.T
-        w = np.asarray(w)
+        w = np.asarray(weights[weight_tensor.name])
 
         w_scaled = w * awq_lite[i].best_scale[:, np.newaxis]
         qw, scale = quant_tensor(w_scaled, BLOCK_SIZE)
@@ -750,21 +892,17 @@ def quantize_awq_lite(
         inv_awq_scale = 1.0 / awq_lite[i].best_scale
         # TODO: evaluate accuracy and perf when scale is evaluated as follows
         # scale = inv_awq_scale[:,np.newaxis].__matmul__(scale)
-        scales[weight_tensor.name] = scale.astype(
-            onnx.mapping.TENSOR_TYPE_MAP[gemm_io_type].np_dtype
-        )
+        scales[weight_tensor.name] = scale.astype(io_dtype)
         gemm_weights_quantized[weight_tensor.name] = numpy.asarray(qw).astype(numpy.int8)
         input_tensors[weight_tensor.name] = act_tensor.name
-        pqs_value = (
-            inv_awq_scale[:, np.newaxis].astype(onnx.mapping.TENSOR_TYPE_MAP[gemm_io_type].np_dtype)
-        ).T
+        pqs_value = (inv_awq_scale[:, np.newaxis].astype(io_dtype)).T
         if has_cupy:
             pqs_value = np.asnumpy(pqs_value)
         pre_quant_scale[weight_tensor.name] = pqs_value
 
         # Change the input activation type to the expected type, fp16 by default
         # TODO: cast input C for Gemm
-        _change_input_type(onnx_model.graph, act_tensor.name, gemm_io_type)
+        _change_input_type(type_infos, act_tensor.name, gemm_io_type)
 
     logging.info(f"Quantizing actual weights took {time.time() - t} seconds")
 
@@ -787,13 +925,6 @@ def quantize_awq_lite(
     model.ir_version = 9
     logging.info(f"Exporting took {time.time() - t} seconds")
 
-    try:
-        os.remove(augmented_onnx_path)
-        if use_external_data_format:
-            os.remove(augmented_onnx_path + "_data")
-    except OSError:
-        logging.warn("Augmented ONNX model or external data file was not found!")
-
     return model
 
 
@@ -19,7 +19,6 @@ import onnx
 import onnx_graphsurgeon as gs
 from onnx_graphsurgeon.ir.graph import Graph
 from onnx_graphsurgeon.ir.node import Node
-from onnxmltools.utils.float16_converter import convert_float_to_float16
 from onnxruntime.quantization import CalibrationMethod
 from onnxruntime.quantization.calibrate import CalibrationDataReader
 
@@ -225,6 +224,9 @@ def quantize(
         replace_scale_values(onnx_model.graph, act_scales_dict)
 
     if high_precision_dtype == "fp16":
+        # onnxmltools is slow to import and only needed here, so import it on first use.
+        from onnxmltools.utils.float16_converter import convert_float_to_float16
+
         # We need to convert float to float16 so as to speed up layers like LayerNorm or GroupNorm.
         logging.info("Converting float tensors to float16")
         onnx_model = convert_float_to_float16(
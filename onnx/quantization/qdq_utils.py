@@ -22,7 +22,7 @@ from onnx.reference.ops.op_cast import Cast_19 as Cast
 
 from modelopt.onnx.quantization.graph_utils import (
     get_tensor_consumer_nodes,
-    get_tensor_producer_nodes,
+    get_tensor_producer_and_consumer_nodes,
 )
 
 QUANTIZE_NODE_NAME = "QuantizeLinear"
@@ -534,8 +534,7 @@ def qdq_to_dq(
 
     _remove_unnecessary_cast()
 
-    tensor_producers = get_tensor_producer_nodes(graph)
-    tensor_consumers = get_tensor_consumer_nodes(graph)
+    tensor_producers, tensor_consumers = get_tensor_producer_and_consumer_nodes(graph)
 
     dangling_q_indices = []
     dangling_init_indices = []
@@ -52,10 +52,8 @@ def pack_float32_to_4bit_optimized(array: Union[np.ndarray, Sequence], signed: b
     array_flat = np.rint(array_flat).astype(dtype)
     assert len(array_flat) % 2 == 0, "array length must be even at this point"
     assert len(array_flat) == inp_arr_len, "output-length must match the input-length"
-    output_list = []
-    for i in range(0, inp_arr_len, 2):
-        output_list.append((array_flat[i + 1] << 4) | (array_flat[i] & 0x0F))
-    arr = np.array(output_list)
+    # Pack the odd elements into the high nibble and the even ones into the low nibble in one pass
+    arr = (array_flat[1::2] << 4) | (array_flat[0::2] & 0x0F)
     return arr.astype(np.uint8)
 
 
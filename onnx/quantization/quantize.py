@@ -30,12 +30,13 @@ import logging
 import os
 import shutil
 import tempfile
-from typing import List, Tuple
+from typing import List, Optional, Tuple
 
 import numpy as np
 import onnx
 import onnx.onnx_cpp2py_export.checker as C  # noqa: N812
 import onnx_graphsurgeon as gs
+from onnx.external_data_helper import uses_external_data
 
 from modelopt.onnx.quantization.calib_utils import (
     CalibrationDataProvider,
@@ -74,12 +75,19 @@ QUANT_MODES = [
 logging.getLogger().setLevel(logging.INFO)
 
 
+def _uses_external_data(onnx_model: onnx.onnx_ml_pb2.ModelProto) -> bool:
+    tensors = [*onnx_model.graph.initializer]
+    for node in onnx_model.graph.node:
+        tensors.extend(attr.t for attr in node.attribute if attr.HasField("t"))
+    return any(uses_external_data(tensor) for tensor in tensors)
+
+
 def _preprocess_onnx(
     onnx_path: str,
     use_external_data_format: bool,
     output_path: str,
     trt_plugins_precision: List[str],
-) -> Tuple[str, List[str], bool]:
+) -> Tuple[str, Optional[onnx.onnx_ml_pb2.ModelProto], List[str], bool]:
     # Load the model and weights
     onnx_model = onnx.load(onnx_path, load_external_data=use_external_data_format)
 
@@ -133,10 +141,18 @@ def _preprocess_onnx(
             if precision == "fp16":
                 custom_ops_to_cast.append(op_type)
         if custom_ops_to_cast:
-            onnx_path = add_fp16_fp32_cast(onnx_path, custom_ops_to_cast)
+            # Reuse the loaded model unless saving it has moved its weights to external data
+            loaded_model = None if _uses_external_data(onnx_model) else onnx_model
+            onnx_path = add_fp16_fp32_cast(onnx_path, custom_ops_to_cast, loaded_model)
             logging.info("Adding cast nodes related to custom ops to match requested precisions.")
             intermediate_generated_files.append(onnx_path)
-    return onnx_path, intermediate_generated_files, has_custom_op
+            # The in-memory model no longer matches the model saved at onnx_path
+            onnx_model = None
+
+    # Saving with external data moves the weights out of the in-memory model
+    if onnx_model is not None and _uses_external_data(onnx_model):
+        onnx_model = None
+    return onnx_path, onnx_model, intermediate_generated_files, has_custom_op
 
 
 def quantize(
@@ -242,7 +258,7 @@ def quantize(
         logging.info(f"No output path specified, save quantized model to {output_path}")
 
     # We need to preprocess the model with naming, weight duplication etc.
-    onnx_path, intermediate_generated_files, has_custom_op = _preprocess_onnx(
+    onnx_path, preprocessed_model, intermediate_generated_files, has_custom_op = _preprocess_onnx(
         onnx_path, use_external_data_format, output_path, trt_plugins_precision
     )
     # If the model has a custom op and no plugin path was given, assume that this custom op is being implemented
@@ -273,7 +289,10 @@ def quantize(
             disable_mha_qdq,
             quantize_mode == "fp8" and high_precision_dtype == "fp16",
             intermediate_generated_files,
+            model=preprocessed_model,
         )
+    # Release the preprocessed model, the quantizers load the model from onnx_path
+    del preprocessed_model
 
     if quantize_mode in ["fp8", "int8"]:
         quantize_func = quantize_int8 if quantize_mode == "int8" else quantize_fp8
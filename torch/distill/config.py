@@ -13,6 +13,7 @@
 from typing import Any, Callable, Dict, Optional, Tuple, Type, Union
 
 import pydantic
+import torch
 import torch.nn as nn
 from torch.nn.modules.loss import _Loss as Loss
 
@@ -73,6 +74,32 @@ class KDLossConfig(ModeloptBaseConfig):
             ".. note: Set to False if using `FSDP <https://pytorch.org/docs/stable/fsdp.html>`_"
         ),
     )
+    offload_teacher_activations: bool = ModeloptField(
+        default=False,
+        title="Offload teacher activations",
+        description=(
+            "Copy the captured teacher layer outputs to pinned CPU memory on a side CUDA stream and"
+            " only move them back to the GPU when the distillation loss is computed. This reduces"
+            " peak GPU memory at the cost of host-device transfers."
+        ),
+    )
+    overlap_teacher_forward: bool = ModeloptField(
+        default=False,
+        title="Overlap teacher forward",
+        description=(
+            "Run the teacher forward pass on a side CUDA stream so it can overlap with the student"
+            " forward pass. Captured teacher outputs are synchronized before the loss uses them."
+        ),
+    )
+    teacher_capture_dtype: Optional[torch.dtype] = ModeloptField(
+        default=None,
+        title="Teacher capture dtype",
+        description=(
+            "If set (e.g. ``torch.bfloat16``), captured floating-point teacher outputs are downcast"
+            " to this dtype to reduce their memory footprint and bandwidth. They are cast back to"
+            " the student output's dtype before the distillation loss is computed."
+        ),
+    )
 
     @pydantic.field_validator("criterion")
     @classmethod
@@ -99,6 +126,8 @@ class KDLossConfig(ModeloptBaseConfig):
                     Optional[DistillationLossBalancer], config=self.model_config
                 ).validate_python(v)
                 continue
+            if k == "teacher_capture_dtype":
+                continue
             assert v is not None, f"Missing required field: {k}."
 
         # Cannot have multiple loss layers without LossBalancer.
@@ -12,8 +12,11 @@
 
 """Meta-model wrapper to support knowledge-distillation learning."""
 
+import functools
 import inspect
 import warnings
+import weakref
+from collections import Counter
 from contextlib import contextmanager
 from typing import Any, Callable, Dict, Optional, Tuple, Union
 
@@ -30,25 +33,48 @@ __all__ = ["DistillationModel"]
 # Avoid multiple printouts of warnings in train loop.
 warnings.simplefilter("once")
 
+# Student forward signatures exposed by ``DistillationModel.forward``, per student class.
+_FORWARD_SIGNATURES: "weakref.WeakKeyDictionary[type, inspect.Signature]" = (
+    weakref.WeakKeyDictionary()
+)
+
 
 class DistillationModel(DynamicModule):
     """Class to encapsulate multiple teacher and student models as a single model."""
 
     def _setup(self):
-        self._register_temp_attribute("_layers_to_loss", {})
+        self._register_temp_attribute("_student_layers", [])
+        self._register_temp_attribute("_teacher_layers", [])
+        self._register_temp_attribute("_loss_fns", [])
         self._register_temp_attribute("_loss_balancer", None)
         self._register_temp_attribute("_expose_minimal_state_dict", None)
         self._register_temp_attribute("_teacher_model", None)
         self._register_temp_attribute("_loss_modules", nn.ModuleList())
+        self._register_temp_attribute("_offload_teacher_activations", False)
+        self._register_temp_attribute("_loss_state", _KDLossState())
+        self._register_temp_attribute("_loss_names", [])
+        self._register_temp_attribute("_teacher_stream", None)
+        self._register_temp_attribute("_teacher_done", None)
+        self._register_temp_attribute("_teacher_capture_dtype", None)
+        self._register_temp_attribute("_teacher_graph", None)
+        self._register_temp_attribute("_teacher_graph_inputs", None)
+        self._register_temp_attribute("_teacher_graph_outputs", {})
+        self._register_temp_attribute("_kd_active", True)
+        self._register_temp_attribute("_kd_hook_handles", [])
 
         # HACK: set model's forward signature to match student class' original.
         # Needed for HF `transformers.utils.find_labels` which relies on inspecting class signature.
-        sig_old = inspect.signature(self.original_cls.forward)
-        sig_new = inspect.signature(type(self).forward)
-        type(self).forward.__signature__ = sig_new.replace(  # type: ignore[attr-defined]
-            parameters=tuple(sig_old.parameters.values()),
-            return_annotation=sig_old.return_annotation,
-        )
+        # The signature is computed once per student class; `forward` is shared by all of them, so
+        # it is re-assigned (cheaply) for every instance.
+        sig = _FORWARD_SIGNATURES.get(self.original_cls)
+        if sig is None:
+            sig_old = inspect.signature(self.original_cls.forward)
+            sig_new = inspect.signature(type(self).forward)
+            sig = _FORWARD_SIGNATURES[self.original_cls] = sig_new.replace(
+                parameters=tuple(sig_old.parameters.values()),
+                return_annotation=sig_old.return_annotation,
+            )
+        type(self).forward.__signature__ = sig  # type: ignore[attr-defined]
 
     def modify(
         self,
@@ -62,6 +88,9 @@ class DistillationModel(DynamicModule):
         ],
         loss_balancer: Optional[DistillationLossBalancer] = None,
         expose_minimal_state_dict: bool = True,
+        offload_teacher_activations: bool = False,
+        overlap_teacher_forward: bool = False,
+        teacher_capture_dtype: Optional[torch.dtype] = None,
     ):
         """Constructor.
 
@@ -75,21 +104,43 @@ class DistillationModel(DynamicModule):
             expose_minimal_state_dict: If True, will hide teacher's state dict when calling ``state_dict`` on this
                 class. This allows avoiding to save the teacher state unnecessarily during checkpointing.
                 .. note: Set to False if using `FSDP <https://pytorch.org/docs/stable/fsdp.html>`_
+            offload_teacher_activations: If True, captured teacher layer outputs are copied to
+                pinned CPU memory on a side CUDA stream and only brought back to the GPU when the
+                loss needs them. This lowers peak GPU memory at the cost of host-device transfers.
+            overlap_teacher_forward: If True and CUDA is available, the teacher forward pass is
+                launched on a side CUDA stream so it can overlap with the student forward pass.
+                Each captured teacher output is only consumed after its layer has finished.
+            teacher_capture_dtype: If set (e.g. ``torch.bfloat16``), captured floating-point teacher
+                outputs with wider dtypes are downcast to it. They are cast back to the student
+                output's dtype right before the loss, so only the stored targets lose precision.
         """
         self._loss_balancer = loss_balancer
         self._expose_minimal_state_dict = expose_minimal_state_dict
-
-        # Assign loss to specified modules.
-        self._layers_to_loss = {
+        self._offload_teacher_activations = offload_teacher_activations
+        self._teacher_capture_dtype = teacher_capture_dtype
+
+        # Assign loss to specified modules. Submodules are looked up in one walk of each model;
+        # `get_submodule` is only used for names it misses, to raise its usual error.
+        student_modules = dict(self.named_modules(remove_duplicate=False))
+        teacher_modules = dict(teacher_model.named_modules(remove_duplicate=False))
+        layers_to_loss = {
             (
-                self.get_submodule(student_layer_name),
-                teacher_model.get_submodule(teacher_layer_name),
+                _lookup_submodule(self, student_modules, student_layer_name),
+                _lookup_submodule(teacher_model, teacher_modules, teacher_layer_name),
             ): loss_fn
             for (
                 student_layer_name,
                 teacher_layer_name,
             ), loss_fn in criterion.items()
         }
+        # Layer pairs are stored as parallel lists indexed by the pair index.
+        self._student_layers = [student_layer for student_layer, _ in layers_to_loss]
+        self._teacher_layers = [teacher_layer for _, teacher_layer in layers_to_loss]
+        self._loss_fns = list(layers_to_loss.values())
+
+        self._loss_names = [
+            f"{loss_fn.__class__.__name__}_{idx}" for idx, loss_fn in enumerate(self._loss_fns)
+        ]
 
         # Register all child modules not automatically registered with assignment operator.
         # This is done to ensure that the parameters of all the underlying nn.Modules
@@ -97,21 +148,79 @@ class DistillationModel(DynamicModule):
         # child modules of DistillationModel object. These might be needed when attaching
         # model params to optimizer, saving/restoring state of DistillationModel etc.
         self._teacher_model = teacher_model
-        self._loss_modules = nn.ModuleList(
-            set(m for m in self._layers_to_loss.values() if len(list(m.parameters())) > 0)
-        )
-
-        # Disable grad for teacher
+        # Deduplicate by identity, keeping the criterion order; stop at the first parameter found.
+        loss_modules = {}
+        for m in self._loss_fns:
+            if id(m) not in loss_modules and next(m.parameters(), None) is not None:
+                loss_modules[id(m)] = m
+        self._loss_modules = nn.ModuleList(loss_modules.values())
+
+        # Disable grad for teacher and keep it in eval mode (see `train`)
         self._teacher_model.requires_grad_(False)
+        self._teacher_model.eval()
 
         # Register hooks for intermediate outputs from teacher models and the student model.
         # HACK: For inexplicable reasons, sometimes a model will have hooks remain after
         #   `ato.restore()` so we check if they are present accidentally first.
-        for student_layer, teacher_layer in self._layers_to_loss:
-            if output_capture_fwd_hook not in student_layer._forward_hooks.values():
-                student_layer.register_forward_hook(output_capture_fwd_hook)
-            if output_capture_fwd_hook not in teacher_layer._forward_hooks.values():
-                teacher_layer.register_forward_hook(output_capture_fwd_hook)
+        # The student hooks compute each pair's loss as soon as the student output is available,
+        # so captured teacher outputs are released during the student forward pass.
+        if overlap_teacher_forward and torch.cuda.is_available():
+            self._teacher_stream = torch.cuda.Stream()
+        if offload_teacher_activations:
+            # Offloaded outputs are already synchronized with the consuming stream on reload.
+            teacher_hook = output_offload_fwd_hook
+        elif self._teacher_stream is not None:
+            teacher_hook = output_stream_fwd_hook
+        else:
+            teacher_hook = output_capture_fwd_hook
+        if teacher_capture_dtype is not None:
+            teacher_hook = functools.partial(teacher_hook, capture_dtype=teacher_capture_dtype)
+        teacher_layer_uses = Counter(self._teacher_layers)
+        self._loss_state = _KDLossState()
+        for student_layer in self._student_layers:
+            for handle_id, hook in list(student_layer._forward_hooks.items()):
+                if hook is output_capture_fwd_hook or isinstance(hook, _KDLossFwdHook):
+                    del student_layer._forward_hooks[handle_id]
+        for teacher_layer in teacher_layer_uses:
+            for handle_id, hook in list(teacher_layer._forward_hooks.items()):
+                if getattr(hook, "func", hook) in _TEACHER_HOOKS:
+                    del teacher_layer._forward_hooks[handle_id]
+            teacher_layer.register_forward_hook(teacher_hook)
+        self._kd_hook_handles = []
+        for idx, (student_layer, teacher_layer, loss_fn) in enumerate(
+            zip(self._student_layers, self._teacher_layers, self._loss_fns)
+        ):
+            handle = student_layer.register_forward_hook(
+                _KDLossFwdHook(
+                    idx,
+                    teacher_layer,
+                    loss_fn,
+                    self._loss_state,
+                    release_teacher_output=teacher_layer_uses[teacher_layer] == 1,
+                    restore_dtype=teacher_capture_dtype is not None,
+                )
+            )
+            self._kd_hook_handles.append(handle)
+
+    def export(self) -> nn.Module:
+        """Remove the student loss hooks and export the student model.
+
+        The hooks reference the teacher layers and loss functions, so they must not outlive the
+        distillation model.
+        """
+        for handle in self._kd_hook_handles:
+            handle.remove()
+        for student_layer in self._student_layers:
+            student_layer.__dict__.pop("_intermediate_output", None)
+        return super().export()
+
+    def train(self, mode: bool = True):
+        """Set the student's training mode; the teacher is always kept in eval mode."""
+        super().train(mode)
+        # Calling `.train()` on this class inadvertently calls it on teacher too.
+        if isinstance(self._teacher_model, nn.Module):
+            self._teacher_model.eval()
+        return self
 
     @property
     def teacher_model(self) -> nn.ModuleList:
@@ -150,6 +259,19 @@ class DistillationModel(DynamicModule):
         finally:
             self._loss_modules = loss_modules
 
+    @contextmanager
+    def kd_mode(self, enable=True):
+        """Context manager to temporarily disable distillation, e.g. for student-only inference.
+
+        While disabled, the forward pass skips the teacher and no layer outputs are captured.
+        """
+        kd_active = self._kd_active
+        self._kd_active = enable
+        try:
+            yield
+        finally:
+            self._kd_active = kd_active
+
     def state_dict(self, *args, **kwargs) -> Dict[str, Any]:
         """Override to potentially return the state without teacher's."""
         with self.hide_teacher_model(enable=self._expose_minimal_state_dict):
@@ -178,19 +300,125 @@ class DistillationModel(DynamicModule):
         Returns:
             The student model's output.
         """
+        # Drop losses of a previous forward pass that were never consumed by `compute_kd_loss`.
+        self._loss_state.pending_losses.clear()
+
+        if not self._kd_active:
+            return super().forward(*args, **kwargs)
+
         # Call teacher model's forward pass for layer outputs to get computed.
         # no_grad() context lets pytorch know not to save activations for
         # teacher models in memory as there won't be any gradient updates applied
         # to these layers. This consumes less memory than just freezing teacher model weights.
-        with torch.no_grad():
-            # Calling `.train()` on this class inadvertently calls it on teacher too.
-            self._teacher_model.eval()
-            self._teacher_model(*args, **kwargs)
-
-        student_output = super().forward(*args, **kwargs)
+        if self._teacher_graph is not None:
+            self._replay_teacher_graph(args, kwargs)
+        else:
+            with torch.no_grad(), self._teacher_stream_context(args, kwargs):
+                # `train` keeps the teacher in eval mode; only re-walk it if switched directly.
+                if self._teacher_model.training:
+                    self._teacher_model.eval()
+                self._teacher_model(*args, **kwargs)
+
+        # Losses can only be computed in the student hooks if nothing recomputes the student
+        # layers; otherwise the student outputs are captured for `compute_kd_loss`.
+        self._loss_state.eager = (
+            self.training and torch.is_grad_enabled() and not _uses_gradient_checkpointing(self)
+        )
+        self._loss_state.in_forward = True
+        try:
+            student_output = super().forward(*args, **kwargs)
+        finally:
+            self._loss_state.in_forward = False
 
         return student_output
 
+    @contextmanager
+    def _teacher_stream_context(self, args: Tuple, kwargs: Dict[str, Any]):
+        """Run the teacher forward on the side stream, if overlapping is enabled."""
+        if self._teacher_stream is None:
+            yield
+            return
+        # The teacher must see the inputs produced on the current stream, and anything after this
+        # point on the current stream must not overtake the previous step's teacher work.
+        self._wait_for_teacher()
+        self._teacher_stream.wait_stream(torch.cuda.current_stream())
+        # Teacher layers after the last paired one may still read the inputs once forward returns,
+        # so the caching allocator must not hand their memory back to the current stream until then.
+        _record_stream((args, kwargs), self._teacher_stream)
+        with torch.cuda.stream(self._teacher_stream):
+            yield
+        self._teacher_done = self._teacher_stream.record_event()
+
+    def _wait_for_teacher(self):
+        """Order the current stream after the whole last teacher forward pass."""
+        if self._teacher_done is not None:
+            torch.cuda.current_stream().wait_event(self._teacher_done)
+            self._teacher_done = None
+
+    def capture_teacher_graph(self, *args, num_warmup_iters: int = 3, **kwargs):
+        """Capture the teacher forward pass into a CUDA graph which later forward passes replay.
+
+        This removes the Python and kernel-launch overhead of the teacher forward pass (including
+        its capture hooks) when the inputs keep the same shapes across steps, e.g. fixed-length
+        sequences. Subsequent forward passes copy their tensor inputs into the captured ones; other
+        inputs must be equal to the captured ones. The student forward pass and the losses still
+        run eagerly since they need autograd. Call again to re-capture, e.g. for new shapes.
+
+        .. note: Captured teacher outputs are overwritten by the next replay, so the backward pass
+            of a step must run before the next forward pass.
+
+        Args:
+            *args: Positional example inputs to the teacher model, on the CUDA device.
+            num_warmup_iters: Number of eager teacher forward passes to run before capture.
+            **kwargs: Named example inputs to the teacher model, on the CUDA device.
+        """
+        assert not self._offload_teacher_activations and self._teacher_stream is None, (
+            "Teacher CUDA graph cannot be combined with offloading or overlapping teacher forward."
+        )
+        self._teacher_graph = None
+        self._teacher_model.eval()
+        teacher_layers = dict.fromkeys(self._teacher_layers)
+
+        # Warm up on a side stream as required by CUDA graph capture.
+        stream = torch.cuda.Stream()
+        stream.wait_stream(torch.cuda.current_stream())
+        with torch.no_grad(), torch.cuda.stream(stream):
+            for _ in range(num_warmup_iters):
+                self._teacher_model(*args, **kwargs)
+        torch.cuda.current_stream().wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.no_grad(), torch.cuda.graph(graph):
+            self._teacher_model(*args, **kwargs)
+        self._teacher_graph_outputs = {
+            layer: layer.__dict__.pop("_intermediate_output") for layer in teacher_layers
+        }
+        self._teacher_graph_inputs = (args, kwargs)
+        self._teacher_graph = graph
+
+    def _replay_teacher_graph(self, args: Tuple, kwargs: Dict[str, Any]):
+        """Copy inputs into the captured ones, replay the teacher graph and expose its outputs."""
+        static_args, static_kwargs = self._teacher_graph_inputs
+        if len(args) != len(static_args) or kwargs.keys() != static_kwargs.keys():
+            raise ValueError("Inputs do not match the ones the teacher graph was captured with.")
+        for static, new in zip(
+            (*static_args, *static_kwargs.values()), (*args, *(kwargs[k] for k in static_kwargs))
+        ):
+            if isinstance(static, torch.Tensor):
+                if not isinstance(new, torch.Tensor) or new.shape != static.shape:
+                    raise ValueError(
+                        "Tensor inputs must keep the shapes the teacher graph was captured with."
+                    )
+                if new is not static:
+                    static.copy_(new)
+            elif new is not static and new != static:
+                raise ValueError(
+                    "Non-tensor inputs must equal the ones the teacher graph was captured with."
+                )
+        self._teacher_graph.replay()
+        for layer, output in self._teacher_graph_outputs.items():
+            setattr(layer, "_intermediate_output", output)
+
     def compute_kd_loss(
         self,
         student_loss: Optional[torch.Tensor] = None,
@@ -215,20 +443,31 @@ class DistillationModel(DynamicModule):
         if student_loss is not None:
             loss_dict[STUDENT_LOSS_KEY] = student_loss
 
-        idx = 0
-        for (student_layer, teacher_layer), loss_fn in self._layers_to_loss.items():
-            out_s = getattr(student_layer, "_intermediate_output")
-            out_t = getattr(teacher_layer, "_intermediate_output")
-            delattr(student_layer, "_intermediate_output")
-            delattr(teacher_layer, "_intermediate_output")
-
-            loss = loss_fn(out_s, out_t)  # Student is pred, Teacher is target
+        for idx, loss_fn in enumerate(self._loss_fns):
+            if idx in self._loss_state.pending_losses:
+                # Already computed by the student layer's forward hook.
+                loss = self._loss_state.pending_losses.pop(idx)
+            else:
+                # Student output was only captured, e.g. in eval mode or with gradient checkpointing.
+                out_s = getattr(self._student_layers[idx], "_intermediate_output")
+                out_t = getattr(self._teacher_layers[idx], "_intermediate_output")
+                out_t = _retrieve_teacher_output(out_t)
+                if self._teacher_capture_dtype is not None:
+                    out_t = _match_dtype(out_t, out_s)
+                loss = loss_fn(out_s, out_t)  # Student is pred, Teacher is target
             if loss_reduction_fn is not None:
                 # Needed in cases where a loss mask is used on non-scalar loss-fn outputs, prior to
                 # reducing to a scalar loss value.
                 loss = loss_reduction_fn(loss)
-            loss_dict[f"{loss_fn.__class__.__name__}_{idx}"] = loss
-            idx += 1
+            loss_dict[self._loss_names[idx]] = loss
+
+        # Release whatever outputs are still captured, e.g. teacher layers shared by several pairs.
+        # Captured outputs are plain instance attributes; `__dict__` skips `nn.Module.__getattr__`.
+        for layer in (*self._student_layers, *self._teacher_layers):
+            layer.__dict__.pop("_intermediate_output", None)
+
+        # Teacher work past the last captured layer may still be running on the side stream.
+        self._wait_for_teacher()
 
         if skip_balancer:
             # Needed for special case if reduction needs to be done separately before balancing.
@@ -243,14 +482,231 @@ class DistillationModel(DynamicModule):
         return loss_total
 
 
+def _lookup_submodule(
+    model: nn.Module, named_modules: Dict[str, nn.Module], name: str
+) -> nn.Module:
+    """Return ``model``'s submodule ``name`` from its precomputed ``named_modules`` table."""
+    module = named_modules.get(name)
+    return model.get_submodule(name) if module is None else module
+
+
+def _record_stream(obj: Any, stream: torch.cuda.Stream):
+    """Mark every CUDA tensor in a (possibly nested tuple/list/dict) input as used on ``stream``."""
+    if isinstance(obj, torch.Tensor):
+        if obj.is_cuda:
+            obj.record_stream(stream)
+    elif isinstance(obj, (tuple, list)):
+        for o in obj:
+            _record_stream(o, stream)
+    elif isinstance(obj, dict):
+        for o in obj.values():
+            _record_stream(o, stream)
+
+
+def _uses_gradient_checkpointing(model: nn.Module) -> bool:
+    """Whether any submodule has (HF-style) ``gradient_checkpointing`` enabled."""
+    # Checking `__dict__` directly avoids the slow `nn.Module.__getattr__` fallback on a miss.
+    return any(m.__dict__.get("gradient_checkpointing", False) for m in model.modules())
+
+
 def output_capture_fwd_hook(
-    module: nn.Module, input: Any, output: Any
+    module: nn.Module, input: Any, output: Any, capture_dtype: Optional[torch.dtype] = None
 ):  # pylint: disable=redefined-builtin  # noqa
-    """A hook to capture layer output."""
+    """A hook to capture layer output, optionally downcast to ``capture_dtype``."""
     # NOTE: Defined externally to allow pickling.
-    if module.training and hasattr(module, "_intermediate_output"):
+    if capture_dtype is not None:
+        output = _downcast(output, capture_dtype)
+    # Checking `__dict__` directly avoids the slow `nn.Module.__getattr__` fallback on a miss.
+    if module.training and "_intermediate_output" in module.__dict__:
         warnings.warn(
             f"Module `{type(module).__name__}` already has an intermediate output stored."
             " This is undesired behavior unless Gradient Checkpointing is in use."
         )
     setattr(module, "_intermediate_output", output)
+
+
+class _KDLossState:
+    """Forward pass state shared by a ``DistillationModel`` and its student layer loss hooks."""
+
+    def __init__(self):
+        # Losses computed by the hooks, keyed by the layer-pair index.
+        self.pending_losses: Dict[int, torch.Tensor] = {}
+        # Whether the hooks may compute the losses instead of capturing the student outputs.
+        self.eager = False
+        # Whether the ``DistillationModel`` forward pass is running, i.e. this is not a recompute.
+        self.in_forward = False
+
+
+class _KDLossFwdHook:
+    """Student layer forward hook computing the layer-pair loss once the student output is ready.
+
+    The loss is stored in the state's pending losses under the pair index and consumed by
+    ``DistillationModel.compute_kd_loss``. In eval mode, with gradient checkpointing, or if the
+    teacher output is not available, the student output is captured instead so the loss is computed
+    outside of any checkpointed region. Recomputations during the backward pass are ignored.
+    """
+
+    # NOTE: Defined as a module-level class (not a closure) to allow pickling.
+    def __init__(
+        self,
+        idx: int,
+        teacher_layer: nn.Module,
+        loss_fn: Loss,
+        state: _KDLossState,
+        release_teacher_output: bool,
+        restore_dtype: bool = False,
+    ):
+        self.idx = idx
+        self.teacher_layer = teacher_layer
+        self.loss_fn = loss_fn
+        self.state = state
+        self.release_teacher_output = release_teacher_output
+        self.restore_dtype = restore_dtype
+
+    def __call__(self, module: nn.Module, input: Any, output: Any):  # noqa: A002
+        if not self.state.in_forward:
+            # Gradient checkpointing recompute in the backward pass; the loss already exists.
+            return
+        teacher_attrs = self.teacher_layer.__dict__
+        if (
+            not self.state.eager
+            or not torch.is_grad_enabled()  # e.g. inside a reentrant checkpointed region
+            or "_intermediate_output" not in teacher_attrs
+        ):
+            output_capture_fwd_hook(module, input, output)
+            return
+        if self.release_teacher_output:
+            out_t = teacher_attrs.pop("_intermediate_output")
+        else:
+            out_t = teacher_attrs["_intermediate_output"]
+        out_t = _retrieve_teacher_output(out_t)
+        if self.restore_dtype:
+            out_t = _match_dtype(out_t, output)
+        # Student is pred, Teacher is target
+        self.state.pending_losses[self.idx] = self.loss_fn(output, out_t)
+
+
+# Side streams used to copy captured teacher outputs to host memory, one per device.
+_OFFLOAD_STREAMS: Dict[torch.device, torch.cuda.Stream] = {}
+
+
+class _OffloadedTensor:
+    """A tensor copied to pinned CPU memory, along with the event marking the end of the copy."""
+
+    def __init__(self, tensor: torch.Tensor):
+        stream = _OFFLOAD_STREAMS.get(tensor.device)
+        if stream is None:
+            stream = _OFFLOAD_STREAMS[tensor.device] = torch.cuda.Stream(tensor.device)
+        # The side stream must not read `tensor` before the producing kernels are done.
+        stream.wait_stream(torch.cuda.current_stream(tensor.device))
+        with torch.cuda.stream(stream):
+            self.cpu_tensor = torch.empty(
+                tensor.shape, dtype=tensor.dtype, device="cpu", pin_memory=True
+            )
+            self.cpu_tensor.copy_(tensor, non_blocking=True)
+            self.event = torch.cuda.Event()
+            self.event.record(stream)
+        # Keep the GPU memory from being reused by the caching allocator until the copy is done.
+        tensor.record_stream(stream)
+        self.device = tensor.device
+
+    def reload(self) -> torch.Tensor:
+        """Copy the tensor back to its original device, ordered after the offload copy."""
+        torch.cuda.current_stream(self.device).wait_event(self.event)
+        return self.cpu_tensor.to(self.device, non_blocking=True)
+
+
+def _map_sequence(fn: Callable, seq: Union[tuple, list]) -> Union[tuple, list]:
+    """Apply ``fn`` to every item of a tuple (including namedtuples) or list."""
+    items = [fn(o) for o in seq]
+    return type(seq)(*items) if hasattr(seq, "_fields") else type(seq)(items)
+
+
+def _offload(output: Any) -> Any:
+    """Offload the CUDA tensors in a (possibly nested tuple/list) layer output to CPU."""
+    if isinstance(output, torch.Tensor):
+        return _OffloadedTensor(output) if output.is_cuda else output
+    if isinstance(output, (tuple, list)):
+        return _map_sequence(_offload, output)
+    return output
+
+
+def _retrieve_teacher_output(output: Any) -> Any:
+    """Inverse of ``_offload`` and ``_stream``; a no-op for outputs captured as-is."""
+    if isinstance(output, (_OffloadedTensor, _StreamedTensor)):
+        return output.reload()
+    if isinstance(output, (tuple, list)):
+        return _map_sequence(_retrieve_teacher_output, output)
+    return output
+
+
+def output_offload_fwd_hook(
+    module: nn.Module, input: Any, output: Any, capture_dtype: Optional[torch.dtype] = None
+):  # pylint: disable=redefined-builtin  # noqa
+    """A hook to capture layer output and offload it to CPU memory until the loss needs it."""
+    # NOTE: Defined externally to allow pickling.
+    if capture_dtype is not None:
+        output = _downcast(output, capture_dtype)
+    setattr(module, "_intermediate_output", _offload(output))
+
+
+class _StreamedTensor:
+    """A tensor produced on the teacher's side stream, with the event marking its completion."""
+
+    def __init__(self, tensor: torch.Tensor):
+        self.tensor = tensor
+        self.event = torch.cuda.current_stream(tensor.device).record_event()
+
+    def reload(self) -> torch.Tensor:
+        """Make the tensor safe to use on the current stream."""
+        stream = torch.cuda.current_stream(self.tensor.device)
+        stream.wait_event(self.event)
+        # The tensor was allocated on the side stream; keep it alive for the consuming stream.
+        self.tensor.record_stream(stream)
+        return self.tensor
+
+
+def _stream(output: Any) -> Any:
+    """Wrap the CUDA tensors in a (possibly nested tuple/list) layer output with their events."""
+    if isinstance(output, torch.Tensor):
+        return _StreamedTensor(output) if output.is_cuda else output
+    if isinstance(output, (tuple, list)):
+        return _map_sequence(_stream, output)
+    return output
+
+
+def output_stream_fwd_hook(
+    module: nn.Module, input: Any, output: Any, capture_dtype: Optional[torch.dtype] = None
+):  # pylint: disable=redefined-builtin  # noqa
+    """A hook to capture a layer output computed on the teacher's side stream."""
+    # NOTE: Defined externally to allow pickling.
+    if capture_dtype is not None:
+        output = _downcast(output, capture_dtype)
+    setattr(module, "_intermediate_output", _stream(output))
+
+
+# Hooks which may be registered on teacher layers, possibly wrapped in a ``functools.partial``.
+_TEACHER_HOOKS = (output_capture_fwd_hook, output_offload_fwd_hook, output_stream_fwd_hook)
+
+
+def _downcast(output: Any, dtype: torch.dtype) -> Any:
+    """Cast the wider floating-point tensors in a (possibly nested) layer output to ``dtype``."""
+    if isinstance(output, torch.Tensor):
+        if output.is_floating_point() and output.element_size() * 8 > torch.finfo(dtype).bits:
+            return output.to(dtype)
+        return output
+    if isinstance(output, (tuple, list)):
+        return _map_sequence(functools.partial(_downcast, dtype=dtype), output)
+    return output
+
+
+def _match_dtype(out_t: Any, out_s: Any) -> Any:
+    """Cast the downcast teacher tensors in ``out_t`` back to the dtypes in ``out_s``."""
+    if isinstance(out_t, torch.Tensor):
+        if isinstance(out_s, torch.Tensor) and out_t.dtype != out_s.dtype:
+            return out_t.to(out_s.dtype) if out_t.is_floating_point() else out_t
+        return out_t
+    if isinstance(out_t, (tuple, list)) and isinstance(out_s, (tuple, list)):
+        items = [_match_dtype(t, s) for t, s in zip(out_t, out_s)] + list(out_t[len(out_s) :])
+        return type(out_t)(*items) if hasattr(out_t, "_fields") else type(out_t)(items)
+    return out_t
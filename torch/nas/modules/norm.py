@@ -10,7 +10,8 @@
 
 """Dynamic norm implementations based on norm modules in torch.nn.modules."""
 
-from typing import List, Optional, Sequence, Tuple, Union
+import math
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
 import torch
 from torch import nn
@@ -61,7 +62,7 @@ class _DynamicBatchInstance(DynamicModule):
         else:
             choices = set(hp.choices)
         choices = {int(make_divisible(c, feature_divisor)) for c in choices}
-        hp.choices = list(set(hp.choices) & choices | {hp.original})
+        hp.choices = [c for c in hp.choices if c in choices or c == hp.original]
 
 
 @DMRegistry.register(
@@ -91,11 +92,19 @@ class _DynamicInstanceNorm(_DynamicBatchInstance):
 class _DynamicLayerNorm(DynamicModule):
     """An ``nn.LayerNorm`` layer with dynamic hyperparams."""
 
+    _normalized_shape_cache: Dict[int, Tuple]
+
     @staticmethod
     def _get_normalized_shape(
         mod: "_DynamicLayerNorm", value: Sequence[Union[int, TracedHp]]
     ) -> Tuple:
-        return tuple(value[:-1]) + (mod.num_features,)
+        # leading dims are static, so the shape only depends on the active num_features
+        num_features = mod.num_features
+        shape = mod._normalized_shape_cache.get(num_features)
+        if shape is None:
+            shape = tuple(value[:-1]) + (num_features,)
+            mod._normalized_shape_cache[num_features] = shape
+        return shape
 
     @staticmethod
     def _cut_to_active_features(
@@ -114,6 +123,9 @@ class _DynamicLayerNorm(DynamicModule):
         # register the hyperparameter with a new name
         self._register_hparam("num_features", normalized_shape[-1])
 
+        # cache of the active normalized shape keyed by the active num_features
+        self._register_temp_attribute("_normalized_shape_cache", {})
+
         # register dynamic attributes
         dyn_attrs = ["weight", "bias"]
         for attr in dyn_attrs:
@@ -137,7 +149,7 @@ class _DynamicLayerNorm(DynamicModule):
         else:
             choices = set(hp.choices)
         choices = {int(make_divisible(c, feature_divisor)) for c in choices}
-        hp.choices = list(set(hp.choices) & choices | {hp.original})
+        hp.choices = [c for c in hp.choices if c in choices or c == hp.original]
 
 
 @DMRegistry.register({nn.GroupNorm: "nn.GroupNorm"})
@@ -156,12 +168,10 @@ class _DynamicGroupNorm(DynamicModule):
 
     def _setup(self):
         # register num_channels as hyperparameter
+        # valid choices are the multiples of both num_groups and group_size, i.e., of their lcm
         group_size = self.num_channels // self.num_groups
-        choices = [
-            c
-            for c in range(self.num_groups, self.num_channels + 1)
-            if c % self.num_groups == 0 and c % group_size == 0
-        ]
+        step = self.num_groups * group_size // math.gcd(self.num_groups, group_size)
+        choices = list(range(step, self.num_channels + 1, step))
         self._register_hparam("num_channels", TracedHp(choices, original=self.num_channels))
 
         # register num_groups as a dynamic attribute so group size is same
@@ -190,4 +200,4 @@ class _DynamicGroupNorm(DynamicModule):
         else:
             choices = set(hp.choices)
         choices = {int(make_divisible(c, channel_divisor)) for c in choices}
-        hp.choices = list(set(hp.choices) & choices | {hp.original})
+        hp.choices = [c for c in hp.choices if c in choices or c == hp.original]
@@ -16,6 +16,8 @@
 
 at::Tensor fake_e4m3fy_cuda(at::Tensor inputs);
 at::Tensor fused_fake_e4m3fy_cuda(at::Tensor inputs, at::Tensor amax, const float zero_threshold);
+at::Tensor fused_fake_e4m3fy_with_axis_cuda(at::Tensor inputs, at::Tensor amax, int axis,
+                                            const float zero_threshold);
 
 at::Tensor fake_e4m3fy(at::Tensor inputs) {
   if (inputs.is_cuda()) {
@@ -36,8 +38,17 @@ at::Tensor fused_fake_e4m3fy(at::Tensor inputs, at::Tensor amax, const float zer
   return fused_fake_e4m3fy_cuda(inputs.contiguous(), amax, zero_threshold);
 }
 
+at::Tensor fused_fake_e4m3fy_with_axis(at::Tensor inputs, at::Tensor amax, int axis,
+                                       const float zero_threshold) {
+  return fused_fake_e4m3fy_with_axis_cuda(inputs.contiguous(), amax.contiguous(), axis,
+                                          zero_threshold);
+}
+
 PYBIND11_MODULE(TORCH_EXTENSION_NAME, m) {
   m.def("fake_e4m3fy", &fake_e4m3fy, "Reduce precision to E4M3", py::arg("inputs"));
   m.def("fused_fake_e4m3fy", &fused_fake_e4m3fy, "Reduce precision to E4M3 (fused)",
         py::arg("inputs"), py::arg("amax"), py::arg("zero_threshold"));
+  m.def("fused_fake_e4m3fy_with_axis", &fused_fake_e4m3fy_with_axis,
+        "Reduce precision to E4M3 with per-channel scaling along axis (fused)", py::arg("inputs"),
+        py::arg("amax"), py::arg("axis"), py::arg("zero_threshold"));
 }
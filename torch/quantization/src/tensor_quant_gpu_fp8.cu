@@ -105,6 +105,49 @@ at::Tensor fused_fake_e4m3fy_cuda(at::Tensor inputs, at::Tensor amax, const floa
   return outputs;
 }
 
+template <typename T>
+__global__ void fused_fake_e4m3fy_with_axis_kernel(const T *inputs, size_t n, const float *amax,
+                                                   int axis_size, int outer_size,
+                                                   float zero_threshold, T *outputs) {
+  int tid = blockIdx.x * blockDim.x + threadIdx.x;
+
+  for (int idx = 4 * tid; idx < 4 * (tid + 1) && idx < n; ++idx) {
+    float x = static_cast<float>(inputs[idx]);
+    int axis_idx = (idx / outer_size) % axis_size;
+
+    // compute scale and inverse-scales of the channel
+    float scale = 448.f / (amax[axis_idx]);
+    float inv_scale = 1.f / scale;
+
+    float output = static_cast<float>(static_cast<__nv_fp8_e4m3>(scale * x)) * inv_scale;
+
+    // zero out small values
+    if (fabsf(x) < zero_threshold) {
+      output = 0.f;
+    }
+
+    outputs[idx] = output;
+  }
+}
+
+at::Tensor fused_fake_e4m3fy_with_axis_cuda(at::Tensor inputs, at::Tensor amax, int axis,
+                                            const float zero_threshold) {
+  size_t numel = inputs.numel();
+  auto outputs = torch::empty_like(inputs);
+  int axis_size = inputs.size(axis);
+  int outer_size = inputs.stride(axis);
+
+  TORCH_CHECK(amax.numel() == axis_size, "amax size must match the size of the quantization axis");
+
+  auto stream = c10::cuda::getCurrentCUDAStream();
+  AT_DISPATCH_FLOATING_TYPES(inputs.type().scalarType(), "fused_fake_e4m3fy_with_axis_cuda", [&] {
+    fused_fake_e4m3fy_with_axis_kernel<<<numel / (BLOCK_SIZE * 4) + 1, BLOCK_SIZE, 0, stream>>>(
+        inputs.data_ptr<scalar_t>(), numel, amax.data_ptr<float>(), axis_size, outer_size,
+        zero_threshold, outputs.data_ptr<scalar_t>());
+  });
+  return outputs;
+}
+
 at::Tensor fake_e4m3fy_cuda(at::Tensor inputs) {
   size_t numel = inputs.numel();
   auto outputs = torch::empty_like(inputs);
@@ -10,13 +10,15 @@
 
 """Basic tensor quantization functions."""
 
+from contextlib import nullcontext
+
 import torch
 import torch._C._onnx as _C_onnx
 from packaging.version import Version
 from torch.autograd import Function
 from torch.onnx import symbolic_helper
 
-from modelopt.torch.quantization.utils import is_torch_library_supported
+from modelopt.torch.quantization.utils import is_torch_export_mode, is_torch_library_supported
 
 from .config import QuantizerAttributeConfig
 from .extensions import get_cuda_ext, get_cuda_ext_fp8
@@ -29,6 +31,40 @@ onnx_dtype_map = {
 
 torch_dtype_map = {"Float": torch.float32, "Half": torch.float16, "BFloat16": torch.bfloat16}
 
+_ASSERT_ASYNC_HAS_MSG = Version(torch.__version__) >= Version("2.1")
+
+
+def _device_context(device: torch.device):
+    """Switch the current CUDA device to ``device`` only if it is not the current one already."""
+    if device.index is None or device.index == torch.cuda.current_device():
+        return nullcontext()
+    return torch.cuda.device(device.index)
+
+
+def _fake_e4m3fy_native(inputs: torch.Tensor, amax: torch.Tensor) -> torch.Tensor:
+    """Fake quantize input to FP8 with the native ``torch.float8_e4m3fn`` dtype.
+
+    Fallback for when ``cuda_ext_fp8`` is not available. Matches the extension, i.e., values are
+    saturated to the E4M3 range (the native cast returns nan instead) and tiny inputs are zeroed.
+    """
+    scale = 1.0 if amax is None else 448.0 / amax.float()
+    outputs = (inputs.float() * scale).clamp_(-448.0, 448.0)
+    outputs = (outputs.to(torch.float8_e4m3fn).float() / scale).to(inputs.dtype)
+    return torch.where(inputs.abs() < 1.0 / (1 << 24), 0.0, outputs)
+
+
+def _assert_async(cond: torch.Tensor, msg: str):
+    """Assert ``cond`` on device without syncing with the host.
+
+    A failure is reported asynchronously as a device-side assert at a later sync point and leaves
+    the CUDA context unusable, i.e., it cannot be caught like a python exception.
+    """
+    # the message overload is only available from torch 2.1
+    if _ASSERT_ASYNC_HAS_MSG:
+        torch._assert_async(cond, msg)
+    else:
+        torch._assert_async(cond)
+
 
 def scaled_e4m3_impl(
     inputs: torch.Tensor,  # TODO: check support for multiple inputs
@@ -46,32 +82,52 @@ def scaled_e4m3_impl(
     """
     cuda_ext_fp8 = get_cuda_ext_fp8()
 
+    if cuda_ext_fp8 is None and hasattr(torch, "float8_e4m3fn"):
+        return _fake_e4m3fy_native(inputs, amax)
+
     assert (
         cuda_ext_fp8 is not None
     ), "cuda_ext_fp8 could not be imported. E4M3 quantization requires CUDA and cuda_ext_fp8."
 
     def is_fusable():
-        # ignore no scaling and shape([]) cases
-        if amax is None or len(amax.shape) == 0:
+        # ignore no scaling case
+        if amax is None:
             return False
         else:
-            # can't have amax.shape = [1, 1, 4, 1] and the like
-            amax_last_dim_only = amax.numel() == amax.shape[-1]
+            # per-tensor amax (incl. shape([])) or amax along the last dim only, i.e., can't have
+            # amax.shape = [1, 1, 4, 1] and the like
+            amax_supported = amax.numel() == 1 or amax.numel() == amax.shape[-1]
             # must be cuda
             all_cuda = inputs.is_cuda and amax.is_cuda
 
             # also check explicit disable.
-            return amax_last_dim_only and all_cuda and (not disable_fused_kernel)
-
-    with torch.cuda.device(
-        None if inputs.device.index == torch.cuda.current_device() else inputs.device.index
-    ):
+            return amax_supported and all_cuda and (not disable_fused_kernel)
+
+    def get_fusable_axis():
+        # per-channel amax along a single (non-last) axis of the inputs, e.g. [C, 1, 1, 1]
+        if amax is None or amax.numel() == 1 or amax.dim() > inputs.dim():
+            return None
+        if not (inputs.is_cuda and amax.is_cuda) or disable_fused_kernel:
+            return None
+        if amax.numel() not in amax.shape:
+            return None
+        # amax broadcasts against the trailing dims of inputs
+        axis = amax.shape.index(amax.numel()) + inputs.dim() - amax.dim()
+        return axis if inputs.shape[axis] == amax.numel() else None
+
+    with _device_context(inputs.device):
+        zero_threshold = 1.0 / (1 << 24)
         # differentiate between fused & unfused cases
-        if is_fusable():
-            zero_threshold = 1.0 / (1 << 24)
+        fusable = is_fusable()
+        axis = None if fusable else get_fusable_axis()
+        if fusable:
             outputs = cuda_ext_fp8.fused_fake_e4m3fy(inputs, amax.float(), zero_threshold)
+        elif axis is not None:
+            outputs = cuda_ext_fp8.fused_fake_e4m3fy_with_axis(
+                inputs, amax.float().squeeze(), axis, zero_threshold
+            )
         else:
-            zero_mask = inputs.abs() < 1.0 / (1 << 24)
+            zero_mask = inputs.abs() < zero_threshold
 
             if amax is None:
                 outputs = cuda_ext_fp8.fake_e4m3fy(inputs)
@@ -83,7 +139,7 @@ def scaled_e4m3_impl(
             # Tiny values could lead to tiny amax and then large scale which cause overflow/saturation
             # and won't go back to normal value after dividing by scale. The right behavior is to mark them
             # as zero which also get rid of inf/nan
-            outputs[zero_mask] = 0.0
+            outputs = torch.where(zero_mask, outputs.new_zeros(()), outputs)
 
         return outputs
 
@@ -98,9 +154,7 @@ def fake_quant_impl(
     """Implementation of fake quantizing input according to number of bits."""
     cuda_ext = get_cuda_ext()
 
-    with torch.cuda.device(
-        None if inputs.device.index == torch.cuda.current_device() else inputs.device.index
-    ):
+    with _device_context(inputs.device):
         if amax.numel() == 1:
             outputs = cuda_ext.fake_tensor_quant(inputs, amax, num_bits, unsigned, narrow_range)
         else:
@@ -180,6 +234,31 @@ if is_torch_library_supported():
             " torch.export will not be supported."
         )
 
+
+def _is_compiling() -> bool:
+    if hasattr(torch, "compiler") and hasattr(torch.compiler, "is_compiling"):
+        return torch.compiler.is_compiling()
+    from torch._dynamo import is_compiling
+
+    return is_compiling()
+
+
+def _get_quantize_op(inputs: torch.Tensor):
+    """Return the quantize op to call for ``inputs``.
+
+    Plain eager tensors call the implementation directly to skip the dispatcher overhead of the
+    ``torch.library`` op. The registered op is kept for export, compilation and tensor subclasses
+    (e.g. fake tensors) which need its abstract implementation.
+    """
+    if (
+        type(inputs) in (torch.Tensor, torch.nn.Parameter)
+        and not is_torch_export_mode()
+        and not _is_compiling()
+    ):
+        return _quantize_impl
+    return quantize_op
+
+
 # Predefined descriptors
 QUANT_DESC_8BIT_PER_TENSOR = QuantizerAttributeConfig(num_bits=8)
 QUANT_DESC_UNSIGNED_8BIT_PER_TENSOR = QuantizerAttributeConfig(num_bits=8, unsigned=True)
@@ -192,11 +271,9 @@ QUANT_DESC_8BIT_CONVTRANSPOSE2D_WEIGHT_PER_CHANNEL = QuantizerAttributeConfig(nu
 QUANT_DESC_8BIT_CONVTRANSPOSE3D_WEIGHT_PER_CHANNEL = QuantizerAttributeConfig(num_bits=8, axis=(0))
 
 
-@torch.jit.script
 def _fake_tensor_quant_backward(inputs, amax, grad_outputs):
-    zero = grad_outputs.new_zeros(1)
-    grad_inputs = torch.where(inputs.abs() <= amax, grad_outputs, zero)
-    return grad_inputs
+    # a python scalar for the zero branch keeps this a single elementwise kernel
+    return torch.where(inputs.abs() <= amax, grad_outputs, 0.0)
 
 
 def _onnx_int8_helper(g, inputs, amax, num_bits, unsigned, narrow_range, trt_high_precision_dtype):
@@ -204,14 +281,16 @@ def _onnx_int8_helper(g, inputs, amax, num_bits, unsigned, narrow_range, trt_hig
     output_shape = torch.onnx.symbolic_helper._get_tensor_sizes(inputs)
     maxbound = (1 << (num_bits - 1 + int(unsigned))) - 1
 
+    # scale and zero point become ONNX constants, so build them once on CPU
+    amax_init_shape = amax.shape
+    amax = amax.detach().cpu()
     if amax.numel() == 1:
-        zero_point, axis = torch.tensor(0.0, device=amax.device), None
+        zero_point, axis = torch.tensor(0.0), None
     else:
-        amax_init_shape = amax.shape
-        amax = amax.squeeze().data
+        amax = amax.squeeze()
         assert len(amax.shape) == 1, "ONNX does not support multi-axis quantization."
-        zero_point = torch.zeros_like(amax, dtype=torch.int32).data
-        axis = list(amax_init_shape).index(list(amax.shape)[0])
+        zero_point = torch.zeros_like(amax, dtype=torch.int32)
+        axis = next(i for i, d in enumerate(amax_init_shape) if d != 1)
 
     zero_point = g.op("Constant", value_t=zero_point.to(torch_dtype_map[trt_high_precision_dtype]))
 
@@ -242,7 +321,7 @@ def _onnx_int8_helper(g, inputs, amax, num_bits, unsigned, narrow_range, trt_hig
 
     # custom ops, so cast the output if needed.
     if trt_high_precision_dtype != input_type:
-        inputs = g.op("Cast", inputs, to_i=onnx_dtype_map[input_type])
+        out = g.op("Cast", out, to_i=onnx_dtype_map[input_type])
 
     return out
 
@@ -277,7 +356,9 @@ class FakeTensorQuantFunction(Function):
         trt_high_precision_dtype="Float",
     ):
         """Forward method."""
-        ctx.save_for_backward(inputs, amax)
+        if ctx.needs_input_grad[0]:
+            # Save the clip mask (1 byte/element) instead of the full input for STE backward
+            ctx.save_for_backward(inputs.abs() <= amax)
 
         def legacy_quant_func():
             # The LegacyFakeTensorQuantFunction support cpu and amax with any shape that can be broadcasted to inputs.
@@ -288,7 +369,7 @@ class FakeTensorQuantFunction(Function):
             outputs = legacy_quant_func()
         else:
             try:
-                outputs = quantize_op(
+                outputs = _get_quantize_op(inputs)(
                     inputs,
                     amax,
                     num_bits=num_bits,
@@ -306,8 +387,11 @@ class FakeTensorQuantFunction(Function):
     @staticmethod
     def backward(ctx, grad_outputs):
         """Implements straight through estimation with clipping."""
-        inputs, amax = ctx.saved_tensors
-        return _fake_tensor_quant_backward(inputs, amax, grad_outputs), None, None, None, None, None
+        if not ctx.needs_input_grad[0]:
+            return None, None, None, None, None, None
+        (clip_mask,) = ctx.saved_tensors
+        grad_inputs = torch.where(clip_mask, grad_outputs, 0.0)
+        return grad_inputs, None, None, None, None, None
 
 
 def _onnx_fp8_quantize(g, inputs, scale_inv, trt_high_precision_dtype):
@@ -378,7 +462,7 @@ class ScaledE4M3Function(Function):
 
         ctx.save_for_backward(inputs)
         ctx.amax = amax
-        outputs = quantize_op(
+        outputs = _get_quantize_op(inputs)(
             inputs, amax, num_bits=8, exponent_bits=4, unsigned=False, narrow_range=False
         )
 
@@ -388,9 +472,11 @@ class ScaledE4M3Function(Function):
     def backward(ctx, grad_outputs):
         """Implements straight through estimation with clipping."""
         (inputs,) = ctx.saved_tensors
-        amax = torch.tensor(
-            ctx.amax if ctx.amax is not None else 448.0, dtype=torch.float32, device=inputs.device
-        )
+        if ctx.amax is None:
+            # fill on device instead of copying a host scalar
+            amax = torch.full((), 448.0, dtype=torch.float32, device=inputs.device)
+        else:
+            amax = ctx.amax.to(dtype=torch.float32, device=inputs.device)
         grad_inputs = _fake_tensor_quant_backward(inputs, amax, grad_outputs)
         return grad_inputs, None, None, None, None
 
@@ -454,13 +540,19 @@ class TensorQuantFunction(Function):
             scale: A Tensor of type float32. outputs / scale will dequantize outputs tensor.
 
         Raises:
-            ValueError:
+            ValueError: If the FP16 scale overflows and the inputs are on CPU. For CUDA inputs the
+                overflow is checked with a device-side assert instead, which fails asynchronously
+                at a later sync and is fatal to the CUDA context.
         """
         ctx.save_for_backward(inputs, amax)
         outputs, scale = _tensor_quant(inputs, amax, num_bits, unsigned, narrow_range)
         # Check if scale overflows FP16
-        if outputs.dtype == torch.half and scale.max() > 65504:
-            raise ValueError(f"scale is too large for FP16 with amax={amax}")
+        if outputs.dtype == torch.half:
+            if scale.is_cuda:
+                # assert on device so that the check does not sync with the host on every forward
+                _assert_async(scale.max() <= 65504, "scale is too large for FP16")
+            elif scale.max() > 65504:
+                raise ValueError(f"scale is too large for FP16 with amax={amax}")
         return outputs, scale.to(inputs.dtype)
 
     @staticmethod
@@ -506,10 +598,19 @@ class LegacyFakeTensorQuantFunction(Function):
 
 
 def _tensor_quant(inputs, amax, num_bits=8, unsigned=False, narrow_range=True):
-    """Shared function body between TensorQuantFunction and FakeTensorQuantFunction."""
+    """Shared function body between TensorQuantFunction and FakeTensorQuantFunction.
+
+    Negative inputs in unsigned quantization raise a ``TypeError`` on CPU. On CUDA they trigger a
+    device-side assert instead, which fails asynchronously and is fatal to the CUDA context.
+    """
     # Fine scale, per channel scale will be handled by broadcasting, which could be tricky. Pop a warning.
     if unsigned:
-        if inputs.min() < 0.0:
+        if inputs.is_cuda:
+            # assert on device so that the check does not sync with the host on every forward
+            _assert_async(
+                inputs.min() >= 0.0, "Negative values encountered in unsigned quantization."
+            )
+        elif inputs.min() < 0.0:
             raise TypeError("Negative values encountered in unsigned quantization.")
 
     # Computation can be done in FP32 to prevent potential over flow.
@@ -519,30 +620,33 @@ def _tensor_quant(inputs, amax, num_bits=8, unsigned=False, narrow_range=True):
     if amax.dtype == torch.half:
         amax = amax.float()
 
-    min_amax = amax.min()
-    if min_amax < 0:
+    if amax.min() < 0:
         raise ValueError("Negative values in amax")
 
-    max_bound = torch.tensor((2.0 ** (num_bits - 1 + int(unsigned))) - 1.0, device=amax.device)
+    # keep the bound a python float so it is not copied to the device on every call
+    max_bound = (2.0 ** (num_bits - 1 + int(unsigned))) - 1.0
     if unsigned:
         min_bound = 0
     elif narrow_range:
         min_bound = -max_bound
     else:
         min_bound = -max_bound - 1
+    if amax.dim() == 0:
+        # match the promotion of the former fp32 0-dim bound, e.g., a bf16 scalar amax gives an
+        # fp32 scale
+        amax = amax.to(torch.promote_types(amax.dtype, torch.float32))
     scale = max_bound / amax
 
+    # Treat amax smaller than minimum representable of fp16 0. The masking is done
+    # unconditionally so that no device sync is needed to check whether any amax is tiny.
     epsilon = 1.0 / (1 << 24)
-    if min_amax <= epsilon:  # Treat amax smaller than minimum representable of fp16 0
-        zero_amax_mask = amax <= epsilon
-        scale[zero_amax_mask] = 0  # Value quantized with amax=0 should all be 0
+    zero_amax_mask = amax <= epsilon
+    scale.masked_fill_(zero_amax_mask, 0.0)  # Value quantized with amax=0 should all be 0
 
     outputs = torch.clamp((inputs * scale).round_(), min_bound, max_bound)
 
-    if min_amax <= epsilon:
-        scale[zero_amax_mask] = (
-            1.0  # Return 1 makes more sense for values quantized to 0 with amax=0
-        )
+    # Return 1 makes more sense for values quantized to 0 with amax=0
+    scale.masked_fill_(zero_amax_mask, 1.0)
 
     if input_dtype == torch.half:
         outputs = outputs.half()
@@ -583,10 +687,10 @@ class FakeAffineTensorQuantFunction(Function):
         max_bound = 2.0 ** (num_bits - 1) - 1
 
         quant_zero = torch.round(min_range / step_size) - min_bound
-        quantized = torch.round(inputs / step_size) - quant_zero
-        quantized = torch.clamp(quantized, min_bound, max_bound)
+        # only the first op allocates, the rest are applied in place on the same buffer
+        quantized = (inputs / step_size).round_().sub_(quant_zero).clamp_(min_bound, max_bound)
 
-        outputs = (quantized + quant_zero) * step_size
+        outputs = quantized.add_(quant_zero).mul_(step_size)
 
         return outputs
 